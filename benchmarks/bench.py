@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''throughput numbers for fetching, formatting, inserting and searching
+
+Everything runs against benchmarks.mocklegistar and a throwaway db in a
+temp dir, so no network is needed and runs are comparable:
+
+    python -m benchmarks.bench --events 500 --latency 0.02 --json before.json
+
+Stages:
+  fetch    fetch_event_items against the mock, events/sec
+  format   format_event over the fetched events, events/sec
+  insert   EventWriter batches and single insert_event calls, rows/sec
+  search   search() for random words from the data, p50/p99 latency
+'''
+
+from typing import Any, Dict, List
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+from benchmarks.mocklegistar import Dataset, MockLegistar
+from legisearch import db, legistar, ratelimit
+from legisearch.fetch import format_event, insert_event, EventWriter
+from legisearch.search import search
+
+NAMESPACE = 'bench'
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def bench_fetch(concurrency: int, enrich=False):
+    started = time.perf_counter()
+    fetched = []
+    async for event, items in legistar.fetch_event_items(
+        NAMESPACE, concurrency=concurrency, cache=False,
+        fetch_matter_text=enrich, fetch_item_extra=enrich,
+    ):
+        fetched.append((event, items))
+    elapsed = time.perf_counter() - started
+    items = sum(len(i) for _, i in fetched)
+    return fetched, {
+        'events': len(fetched),
+        'items': items,
+        'seconds': elapsed,
+        'events_per_sec': len(fetched) / elapsed,
+        'items_per_sec': items / elapsed,
+    }
+
+
+def bench_format(fetched):
+    started = time.perf_counter()
+    events = [format_event(NAMESPACE, e, i) for e, i in fetched]
+    elapsed = time.perf_counter() - started
+    return events, {
+        'events': len(events),
+        'seconds': elapsed,
+        'events_per_sec': len(events) / elapsed,
+    }
+
+
+def row_count(events) -> int:
+    return sum(1 + len(e.items) for e in events)
+
+
+async def bench_insert(events, batch_size: int):
+    await db.create_tables(NAMESPACE)
+    rows = row_count(events)
+    async with db.new_connection(NAMESPACE, begin=False) as conn:
+        started = time.perf_counter()
+        async with EventWriter(conn, batch_size, replace=True) as writer:
+            for event in events:
+                await writer.add(event)
+        batched = time.perf_counter() - started
+    started = time.perf_counter()
+    async with db.new_connection(NAMESPACE) as conn:
+        for event in events:
+            await insert_event(conn, event)
+    single = time.perf_counter() - started
+    return {
+        'rows': rows,
+        'batched_seconds': batched,
+        'batched_rows_per_sec': rows / batched,
+        'single_seconds': single,
+        'single_rows_per_sec': rows / single,
+    }
+
+
+async def bench_search(queries: List[str]):
+    latencies = []
+    results = 0
+    for query in queries:
+        started = time.perf_counter()
+        async for _ in search(NAMESPACE, query):
+            results += 1
+        latencies.append(time.perf_counter() - started)
+    return {
+        'queries': len(queries),
+        'results': results,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def search_words(dataset: Dataset, count: int, seed=2) -> List[str]:
+    words = sorted({
+        w.strip('.,;:()').lower()
+        for items in dataset.items.values()
+        for item in items
+        for w in (item['EventItemTitle'] or '').split()
+        if len(w) > 3
+    })
+    rand = random.Random(seed)
+    return [rand.choice(words) for _ in range(count)]
+
+
+async def run(args) -> Dict[str, Any]:
+    dataset = Dataset(args.events)
+    report: Dict[str, Any] = {
+        'params': {k: v for k, v in vars(args).items() if k != 'json'},
+    }
+    with MockLegistar(dataset, latency=args.latency,
+                      error_rate=args.error_rate,
+                      error_status=args.error_status) as mock:
+        legistar.BASEURL = mock.baseurl
+        ratelimit.configure(rate=args.rate, burst=args.concurrency * 2)
+        ratelimit.BACKOFF = 0.01
+        fetched, report['fetch'] = await bench_fetch(
+            args.concurrency, args.enrich
+        )
+        report['fetch']['requests'] = mock.requests
+        report['fetch']['injected_errors'] = mock.errors
+    events, report['format'] = bench_format(fetched)
+    report['insert'] = await bench_insert(events, args.batch_size)
+    report['search'] = await bench_search(
+        search_words(dataset, args.queries)
+    )
+    await db.dispose_engines()
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def show(report: Dict[str, Any]):
+    fetch, fmt, insert, srch = (
+        report[k] for k in ('fetch', 'format', 'insert', 'search')
+    )
+    print(f'fetch   {fetch["events"]} events, {fetch["items"]} items in '
+          f'{fetch["seconds"]:.2f}s: {fetch["events_per_sec"]:.1f} events/s '
+          f'({fetch["requests"]} requests, '
+          f'{fetch["injected_errors"]} injected errors)')
+    print(f'format  {fmt["events_per_sec"]:.0f} events/s')
+    print(f'insert  {insert["rows"]} rows: '
+          f'{insert["batched_rows_per_sec"]:.0f} rows/s batched, '
+          f'{insert["single_rows_per_sec"]:.0f} rows/s insert_event')
+    print(f'search  {srch["queries"]} queries: p50 {srch["p50_ms"]:.2f}ms '
+          f'p99 {srch["p99_ms"]:.2f}ms')
+    print(f'peak rss {report["peak_rss_mb"]:.0f}MB')
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.bench',
+        description='offline benchmarks against a mock legistar server',
+    )
+    parser.add_argument('-e', '--events', type=int, default=300,
+                        help='events in the mock dataset')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=legistar.CONCURRENCY)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of delay added to each mock response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of mock responses that are errors')
+    parser.add_argument('--error-status', type=int, default=500,
+                        help='status of injected errors. 429 and 503 also '
+                        'make the rate limiter slow down')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='requests per second allowed by the limiter')
+    parser.add_argument('--enrich', action='store_true',
+                        help='also fetch matters, votes and rollcalls')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('-q', '--queries', type=int, default=200,
+                        help='searches to time')
+    parser.add_argument('--json', help='also write the numbers to this file')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    cwd = os.getcwd()
+    # the db goes in a temp dir, namespaces are relative paths
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            report = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+    show(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+'''a local stand in for webapi.legistar.com, for benchmarks
+
+Serves /events, /events/{id}/eventitems, /EventItems/{id}/{subcat},
+/bodies and /Matters from synthetic data made by copying the San Jose
+fixture in documentation/sanjose.json. Understands as much OData as
+legisearch.legistar sends: $top, $select, $orderby and the $filter
+expressions it builds.
+
+Latency and errors can be injected, to see how fetching holds up against a
+slow or flaky server.
+'''
+
+from typing import Any, Callable, Dict, List, Mapping, Optional
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from datetime import datetime, timedelta
+import os
+import re
+import json
+import time
+import random
+import threading
+
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), '..', 'documentation', 'sanjose.json'
+)
+BODIES = {138: 'City Council', 139: 'Planning Commission',
+          140: 'Rules and Open Government Committee'}
+TERM = re.compile(
+    r"(\w+) (eq|ne|gt|ge|lt|le) "
+    r"(?:(null)|datetime'([^']*)'|'([^']*)'|(-?\d+))"
+)
+OPS: Dict[str, Callable[[Any, Any], bool]] = {
+    'eq': lambda a, b: a == b,
+    'ne': lambda a, b: a != b,
+    'gt': lambda a, b: a is not None and a > b,
+    'ge': lambda a, b: a is not None and a >= b,
+    'lt': lambda a, b: a is not None and a < b,
+    'le': lambda a, b: a is not None and a <= b,
+}
+
+
+def parse_filter(text: str) -> Callable[[Mapping[str, Any]], bool]:
+    '''`a and (b or c) and ...`, which is all legistar.py builds'''
+    groups = []
+    for part in re.split(r'\s+and\s+', text.strip()):
+        terms = []
+        for term in re.split(r'\s+or\s+', part.strip().strip('()')):
+            match = TERM.fullmatch(term.strip())
+            if not match:
+                raise ValueError(f'unsupported filter {term!r}')
+            field, op, null, dt, string, number = match.groups()
+            if null:
+                value = None
+            elif number is not None:
+                value = int(number)
+            else:
+                value = dt if dt is not None else string
+            terms.append((field, OPS[op], value))
+        groups.append(terms)
+
+    def predicate(row):
+        return all(
+            any(op(row.get(field), value) for field, op, value in terms)
+            for terms in groups
+        )
+    return predicate
+
+
+def select_fields(row: Mapping[str, Any], select: Optional[str]):
+    if not select:
+        return row
+    # nested selects like EventItemMatterAttachments/MatterAttachmentName
+    # keep the whole expanded field
+    fields = {f.split('/')[0] for f in select.split(',')}
+    return {k: v for k, v in row.items() if k in fields}
+
+
+class Dataset:
+    '''events, items and matters copied from the fixture
+
+    every event gets the fixture's items, with new ids, and titles
+    reshuffled from the fixture's words so searches have something to do
+    '''
+
+    def __init__(self, events=1000, start=datetime(2015, 1, 6), seed=1):
+        rand = random.Random(seed)
+        with open(FIXTURE) as f:
+            fixture = json.load(f)[0]
+        template_items = fixture.pop('items')
+        words = ' '.join(
+            i['EventItemTitle'] or '' for i in template_items
+        ).split()
+        self.events: List[Dict[str, Any]] = []
+        self.items: Dict[int, List[Dict[str, Any]]] = {}
+        self.matters: Dict[int, Dict[str, Any]] = {}
+        item_id = 1
+        for n in range(events):
+            event_id = n + 1
+            when = start + timedelta(days=n // len(BODIES) * 3)
+            body_id = list(BODIES)[n % len(BODIES)]
+            event = dict(
+                fixture,
+                EventId=event_id,
+                EventBodyId=body_id,
+                EventBodyName=BODIES[body_id],
+                EventDate=when.isoformat(),
+                EventLastModifiedUtc=(when + timedelta(days=1)).isoformat(),
+                EventItems=[],
+            )
+            self.events.append(event)
+            items = []
+            for template in template_items:
+                attachments = json.loads(template.get('attachments') or '{}')
+                matter_id = template['EventItemMatterId'] and item_id
+                item = dict(
+                    template,
+                    EventItemId=item_id,
+                    EventItemEventId=event_id,
+                    EventItemMatterId=matter_id,
+                    EventItemLastModifiedUtc=event['EventLastModifiedUtc'],
+                    EventItemTitle=' '.join(rand.sample(
+                        words, min(len(words), rand.randint(5, 40))
+                    )),
+                    EventItemMatterAttachments=[
+                        {'MatterAttachmentName': name,
+                         'MatterAttachmentHyperlink': url}
+                        for name, url in attachments.items()
+                    ],
+                )
+                for key in ('attachments', 'Votes', 'RollCalls'):
+                    item.pop(key, None)
+                items.append(item)
+                if matter_id:
+                    self.matters[matter_id] = {
+                        'MatterId': matter_id,
+                        'MatterFile': f'{when.year % 100}-{matter_id}',
+                        'MatterTitle': item['EventItemTitle'],
+                    }
+                item_id += 1
+            self.items[event_id] = items
+
+    @property
+    def item_count(self) -> int:
+        return sum(map(len, self.items.values()))
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 overflows when matters are fetched, and a
+    # dropped connect costs a second before it is retried
+    request_queue_size = 1024
+
+
+class MockLegistar:
+    '''run the mock on a free local port in a background thread
+
+        with MockLegistar(Dataset(200), latency=0.05) as server:
+            legistar.BASEURL = server.baseurl
+    '''
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        latency=0.0,  # seconds added to each response
+        jitter=0.5,  # latency varies by this fraction either way
+        error_rate=0.0,  # fraction of requests answered with `error_status`
+        error_status=500,
+        host='127.0.0.1',
+        port=0,
+    ):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = Server((host, port), self.handler())
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def baseurl(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, path: str, query: Mapping[str, str]):
+        '''(status, json body) for a request'''
+        data = self.dataset
+        parts = [p for p in path.split('/') if p][2:]  # drop v1/{namespace}
+        parts[0:1] = [parts[0].lower()] if parts else []
+        if parts == ['bodies']:
+            return 200, [{'BodyId': k, 'BodyName': v}
+                         for k, v in BODIES.items()]
+        if parts == ['events']:
+            rows = data.events
+            if '$filter' in query:
+                rows = list(filter(parse_filter(query['$filter']), rows))
+            if '$orderby' in query:
+                rows = sorted(rows, key=lambda r: r[query['$orderby']])
+            rows = rows[:int(query.get('$top', 1000))]
+            return 200, [select_fields(r, query.get('$select')) for r in rows]
+        if len(parts) == 3 and parts[0] == 'events' \
+                and parts[2].lower() == 'eventitems':
+            rows = data.items.get(int(parts[1]), [])
+            if '$filter' in query:
+                rows = list(filter(parse_filter(query['$filter']), rows))
+            rows = rows[:int(query.get('$top', 1000))]
+            return 200, [select_fields(r, query.get('$select')) for r in rows]
+        if len(parts) == 3 and parts[0] == 'eventitems':
+            return 200, []
+        if len(parts) >= 2 and parts[0] == 'matters':
+            matter = data.matters.get(int(parts[1]))
+            if matter is None:
+                return 404, {'Message': 'not found'}
+            return 200, matter if len(parts) == 2 else []
+        return 404, {'Message': f'no route for {path}'}
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, without this every
+            # keep-alive response waits on a delayed ack
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                with mock.lock:
+                    mock.requests += 1
+                    failing = random.random() < mock.error_rate
+                    if failing:
+                        mock.errors += 1
+                if mock.latency:
+                    time.sleep(mock.latency * random.uniform(
+                        1 - mock.jitter, 1 + mock.jitter
+                    ))
+                if failing:
+                    status, body = mock.error_status, {'Message': 'injected'}
+                else:
+                    try:
+                        status, body = mock.route(url.path, query)
+                    except ValueError as e:
+                        status, body = 400, {'Message': str(e)}
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                if failing and status in (429, 503):
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='serve fake legistar data until interrupted'
+    )
+    parser.add_argument('-e', '--events', type=int, default=1000)
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    with MockLegistar(Dataset(args.events), args.latency,
+                      error_rate=args.error_rate, port=args.port) as mock:
+        print(f'serving {args.events} events at {mock.baseurl}')
+        try:
+            mock.thread.join()
+        except KeyboardInterrupt:
+            pass
@@ -1,18 +1,23 @@
-from functools import partial
+import asyncio
+import httpx
 from flask import Flask, request, Response, render_template, jsonify
-from legiscal.cal import gen_ical
-from legisearch.legistar import fetch_bodies
+from legiscal.cal import render_ical, stream_ical
+from legiscal.cache import calendars, NotBuilt
+from legiscal.bodies import bodies as body_cache
+from legiscal.background import iterate, run
+from legisearch.legistar import KNOWN_NAMESPACES
+from legisearch.metrics import registry
 
 app = Flask(__name__)
 BASEURL = 'https://webapi.legistar.com/v1/'
-known_namespaces = {
-    'San Jose': 'sanjose',
-    'Sunnyvale': 'sunnyvaleca',
-    'Santa Clara': 'santaclara',
-    'Mountain View': 'mountainview',
-    'Cupertino': 'cupertino',
-    'BART': 'bart',
-}
+RETRYAFTER = 30  # seconds, for calendars that failed to build
+
+
+@app.before_request
+def preload_bodies():
+    # on the first request rather than at import, so importing the app
+    # does not start a thread and go to the network
+    body_cache.preload(KNOWN_NAMESPACES.values())
 
 
 @app.route('/test')
@@ -21,33 +26,81 @@ def test():
     return request.accept_mimetypes.best_match(options)
 
 
+@app.route('/metrics')
+def metrics():
+    return Response(
+        registry.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+
 @app.route('/')
 def root():
     return render_template(
         'index.html',
-        known_namespaces=known_namespaces
+        known_namespaces=KNOWN_NAMESPACES
     )
 
 
 @app.route('/b/<namespace>')
-def bodies(namespace):
-    bodies = fetch_bodies(namespace)
+async def bodies(namespace):
+    try:
+        bodies = await body_cache.get(namespace)
+    except (httpx.HTTPError, asyncio.TimeoutError):
+        return f'could not get meeting bodies for {namespace}', 503
     renderers = {
         'application/json': jsonify,
         'text/html': lambda b: render_template(
             'bodies.html', namespace=namespace, bodies=b
         )
     }
-    renderer = request.accept_mimetypes.best_match(
+    mimetype = request.accept_mimetypes.best_match(
         ('application/json', 'text/html')
     )
-    return renderer(bodies)
+    return renderers[mimetype or 'text/html'](bodies)
 
 
 @app.route('/c/<namespace>')
 async def cal(namespace):
-    body_list = request.args.getlist('b')
-    nscal = await gen_ical(namespace, bodies=body_list)
-    calbin = nscal.to_ical()
-    resp = Response(calbin, mimetype='text/calendar')
+    body_list = sorted(set(request.args.getlist('b')))
+    if not all(b.isdigit() for b in body_list):
+        return 'b must be meeting body ids, see /b/<namespace>', 400
+    key = (namespace, tuple(body_list))
+    entry = calendars.lookup(key)
+    streamed = None
+    if entry is None:
+        # nothing to fall back on, so send events as they come in
+        # rather than making the client wait for the whole calendar.
+        # None if another request is already doing that, then wait for it
+        try:
+            streamed = calendars.stream(
+                key, lambda: iterate(stream_ical(namespace, bodies=body_list))
+            )
+        except httpx.HTTPError:
+            # the header is made before any of the response goes out
+            return busy(f'could not get the {namespace} calendar')
+    if streamed is not None:
+        etag, modified, chunks = streamed
+        resp = Response(chunks, mimetype='text/calendar')
+        resp.set_etag(etag)
+        resp.last_modified = modified
+        return resp
+
+    async def build():
+        return await run(render_ical(namespace, bodies=body_list))
+
+    try:
+        entry = await calendars.get(key, build)
+    except (httpx.HTTPError, NotBuilt):
+        return busy(f'could not get the {namespace} calendar')
+    resp = Response(entry.body, mimetype='text/calendar')
+    resp.set_etag(entry.etag)
+    resp.last_modified = entry.modified
+    resp.cache_control.public = True
+    resp.cache_control.max_age = entry.max_age
+    return resp.make_conditional(request)
+
+
+def busy(message: str) -> Response:
+    resp = Response(message, status=503, mimetype='text/plain')
+    resp.retry_after = RETRYAFTER
     return resp
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''one event loop for all of the app's async work
+
+flask runs every async view on a new event loop, but db engines and httpx
+clients belong to the loop they were made on. Anything using them is sent
+to this loop instead. It runs in a daemon thread for the life of the
+process, so engines from `db.get_engine` are pooled across requests
+rather than made and leaked once per request.
+'''
+
+from typing import Any, AsyncGenerator, Coroutine, Iterator, Optional, \
+    TypeVar
+from concurrent.futures import Future
+import asyncio
+import threading
+
+T = TypeVar('T')
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    '''the background loop, started on first use'''
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name='legiscal', daemon=True
+            ).start()
+        return _loop
+
+
+def submit(coro: Coroutine[Any, Any, T]) -> 'Future[T]':
+    '''start `coro` on the background loop'''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+async def run(coro: Coroutine[Any, Any, T]) -> T:
+    '''await `coro` on the background loop, from any other loop'''
+    return await asyncio.wrap_future(submit(coro))
+
+
+def iterate(agen: AsyncGenerator[T, None]) -> Iterator[T]:
+    '''drive an async generator from a sync one, flask only streams those'''
+    async def step():
+        return await agen.__anext__()
+
+    try:
+        while True:
+            try:
+                yield submit(step()).result()
+            except StopAsyncIteration:
+                break
+    finally:
+        submit(agen.aclose()).result()
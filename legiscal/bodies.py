@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+'''meeting body lists for the app, kept in memory
+
+Body lists almost never change, so once a namespace has been looked up its
+list is served from memory. After TTL the old list is still served while a
+new one is fetched in the background.
+
+Fetching happens on the app's background loop, sharing one httpx client,
+so flask workers only wait on the network the very first time a namespace
+is asked for.
+'''
+
+from typing import Dict, Optional, Tuple
+from concurrent.futures import Future
+import time
+import asyncio
+import threading
+import httpx
+from legisearch.legistar import new_client, fetch_bodies_async
+from legiscal import background
+
+
+TTL = 24 * 3600  # seconds before a list is refreshed
+TIMEOUT = 30  # seconds to wait for a namespace that was never fetched
+
+
+class BodyCache:
+    def __init__(self):
+        self.entries: Dict[str, Tuple[float, Dict[str, int]]] = {}
+        self.pending: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.preloaded = False
+
+    async def fetch(self, namespace: str) -> Dict[str, int]:
+        if self.client is None:
+            self.client = new_client()
+        bodies = await fetch_bodies_async(namespace, self.client)
+        return {b.BodyName: b.BodyId for b in bodies}
+
+    def refresh(self, namespace: str) -> Future:
+        '''fetch in the background, one fetch per namespace at a time'''
+        with self.lock:
+            if namespace not in self.pending:
+                future = background.submit(self.fetch(namespace))
+                self.pending[namespace] = future
+                future.add_done_callback(
+                    lambda f: self.fetched(namespace, f)
+                )
+            return self.pending[namespace]
+
+    def fetched(self, namespace: str, future: Future):
+        with self.lock:
+            self.pending.pop(namespace, None)
+            if not future.cancelled() and future.exception() is None:
+                self.entries[namespace] = (time.monotonic(), future.result())
+
+    async def get(self, namespace: str) -> Dict[str, int]:
+        '''body name -> id, stale lists are returned as is and refreshed'''
+        entry = self.entries.get(namespace)
+        if entry is None:
+            future = self.refresh(namespace)
+            # shielded, a worker that times out leaves the fetch running
+            # for everyone else waiting on it
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), TIMEOUT
+            )
+        stored, bodies = entry
+        if time.monotonic() - stored > TTL:
+            self.refresh(namespace)
+        return bodies
+
+    def preload(self, namespaces):
+        '''start fetching `namespaces`, only the first call does anything'''
+        with self.lock:
+            if self.preloaded:
+                return
+            self.preloaded = True
+        for namespace in namespaces:
+            self.refresh(namespace)
+
+
+bodies = BodyCache()
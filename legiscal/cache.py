@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+'''in process cache of generated calendars
+
+Calendar clients poll the same urls over and over, and building a calendar
+takes one legistar request per upcoming meeting. Built calendars are kept
+for TTL seconds per (namespace, bodies). When one expires, only the first
+request rebuilds it; concurrent requests for the same key wait for that
+build instead of starting their own.
+
+Every entry has an etag and the time its content last changed, so
+unchanged calendars can be answered with 304. The etag is a hash of the
+body, except for a calendar that was streamed: its etag had to be sent
+before the body was known, so it is made up front and kept for as long as
+rebuilds give the same bytes.
+
+`stream` is the same for a calendar sent while it is being generated,
+it is stored once the last chunk went out. Requests that miss while it is
+going out wait for it like they would for any other build.
+'''
+
+from typing import Awaitable, Callable, Dict, Hashable, Iterator, \
+    NamedTuple, Optional, Tuple, OrderedDict as OrderedDictType
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timezone
+import sys
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+from legisearch.metrics import registry
+
+
+TTL = 15 * 60  # seconds
+MAXENTRIES = 256  # calendars kept, least recently used go first
+LOOKUPS = registry.counter(
+    'legiscal_calendar_cache_total',
+    'calendar cache lookups, by result',
+)
+BUILD_SECONDS = registry.histogram(
+    'legiscal_calendar_build_seconds',
+    'time to generate a calendar',
+)
+
+
+class Entry(NamedTuple):
+    body: bytes
+    etag: str
+    digest: str  # hash of body, the etag unless it was streamed
+    modified: datetime
+    stored: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() - self.stored < TTL
+
+    @property
+    def max_age(self) -> int:
+        return max(0, int(TTL - (time.monotonic() - self.stored)))
+
+
+class NotBuilt(RuntimeError):
+    '''the build that was waited on ended without a calendar'''
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class CalendarCache:
+    '''flask runs each async view on its own loop in its own thread, so
+    waiting on another request's build is done with a concurrent future,
+    not an asyncio one
+
+    the lock only guards the dicts, nothing is built or sent while it is
+    held
+    '''
+
+    def __init__(self, maxentries=MAXENTRIES):
+        self.maxentries = maxentries
+        self.entries: OrderedDictType[Hashable, Entry] = OrderedDict()
+        self.building: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key: Hashable):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(
+        self,
+        key: Hashable,
+        body: bytes,
+        etag: Optional[str] = None,
+        modified: Optional[datetime] = None,
+    ) -> Entry:
+        '''swap in a new body for key
+
+        an unchanged body keeps the etag and modified time it had
+        '''
+        digest = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            old = self.entries.get(key)
+            if old and old.digest == digest:
+                etag, modified = old.etag, old.modified
+            entry = Entry(body, etag or digest, digest, modified or now(),
+                          time.monotonic())
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def claim(self, key: Hashable) -> Tuple[bool, Future]:
+        '''(True, future) if the caller is to build key and then finish
+        the future, else (False, the build to wait for)'''
+        with self.lock:
+            if key in self.building:
+                return False, self.building[key]
+            future: Future = Future()
+            self.building[key] = future
+            return True, future
+
+    def finish(self, key: Hashable, future: Future,
+               entry: Optional[Entry] = None,
+               error: Optional[BaseException] = None):
+        '''end a claimed build with its entry, or the error it failed on'''
+        with self.lock:
+            if self.building.get(key) is future:
+                del self.building[key]
+        if entry is None:
+            future.set_exception(
+                error or NotBuilt(f'calendar {key} was not built')
+            )
+        else:
+            future.set_result(entry)
+
+    async def get(
+        self,
+        key: Hashable,
+        build: Callable[[], Awaitable[bytes]],
+    ) -> Entry:
+        '''the cached entry for key, built with `build` if missing or stale'''
+        entry = self.lookup(key)
+        if entry and entry.fresh:
+            LOOKUPS.inc(result='hit')
+            return entry
+        claimed, future = self.claim(key)
+        try:
+            if not claimed:
+                LOOKUPS.inc(result='shared')
+                # shielded, a waiter giving up must not cancel the build
+                return await asyncio.shield(asyncio.wrap_future(future))
+            built = await self.build(key, build)
+        except Exception as e:
+            if claimed:
+                self.finish(key, future, error=e)
+            # legistar being down is no reason to drop a calendar
+            if entry:
+                return entry
+            raise
+        except BaseException:
+            if claimed:
+                self.finish(key, future)
+            raise
+        self.finish(key, future, built)
+        return built
+
+    async def build(
+        self,
+        key: Hashable,
+        build: Callable[[], Awaitable[bytes]],
+    ) -> Entry:
+        # someone else may have rebuilt it before we claimed it
+        entry = self.lookup(key)
+        if entry and entry.fresh:
+            LOOKUPS.inc(result='shared')
+            return entry
+        LOOKUPS.inc(result='miss')
+        with BUILD_SECONDS.time():
+            body = await build()
+        return self.store(key, body)
+
+    def stream(
+        self,
+        key: Hashable,
+        produce: Callable[[], Iterator[bytes]],
+    ) -> Optional[Tuple[str, datetime, Iterator[bytes]]]:
+        '''(etag, modified, chunks), chunks passes `produce()` through and
+        stores the whole once it is done
+
+        None if key is already being built, `get` waits for that build.
+        Requests for key that come in while the chunks go out wait for
+        this one the same way. If the client hangs up first, nothing is
+        stored and they get NotBuilt.
+
+        The first chunk is made before returning, so an error there is
+        raised here, and the build is always under way to be finished.
+        '''
+        claimed, future = self.claim(key)
+        if not claimed:
+            return None
+        etag, modified = uuid.uuid4().hex, now()
+
+        def chunks():
+            entry = None
+            error = None
+            try:
+                LOOKUPS.inc(result='miss')
+                parts = []
+                started = time.perf_counter()
+                for chunk in produce():
+                    parts.append(chunk)
+                    yield chunk
+                BUILD_SECONDS.observe(time.perf_counter() - started)
+                entry = self.store(key, b''.join(parts), etag, modified)
+            except Exception as e:
+                # the status line went out long ago, the client only sees
+                # the connection drop before the end of the body
+                print(f'calendar {key} failed part way: {e!r}',
+                      file=sys.stderr)
+                LOOKUPS.inc(result='failed')
+                error = e
+                raise
+            finally:
+                self.finish(key, future, entry, error)
+
+        def resume(first: bytes, rest: Iterator[bytes]) -> Iterator[bytes]:
+            yield first
+            yield from rest
+
+        started = chunks()
+        return etag, modified, resume(next(started, b''), started)
+
+
+calendars = CalendarCache()
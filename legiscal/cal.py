@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from typing import Mapping, AsyncGenerator, List, Any
+from typing import Dict, AsyncGenerator, List, Any, Optional, Tuple
 from collections import Counter
-from datetime import date, timedelta, datetime
-from dateutil.parser import parse
-from dateutil.tz import tzutc
+from datetime import date, timedelta, datetime, timezone as tz
 from zoneinfo import ZoneInfo
 import argparse
+import json
+import os
 import sys
 import httpx
-from icalendar import Calendar, Event
-from legisearch.legistar import fetch_event_items
+from icalendar import Calendar, Event as VEvent, vText
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from legisearch import db, dates
+from legisearch.legistar import fetch_event_items, fetch_bodies_async
+from legisearch.fetch import LASTSYNC
+from legisearch.models import Event, EventItem, Attachment
 
 
 EVENTFIELDS = (
@@ -31,6 +36,9 @@ Web Link: {EventInSiteURL}
 
 {items}
 '''
+# in auto mode a db last synced longer ago than this is passed over for the
+# api, upcoming meetings get added and moved all the time
+MAXAGE = timedelta(hours=6)
 CALDESC = '''{namespace} public meetings
 generated by legiscal, based off data from {namespace}.legistar.com
 {bodyinfo}'''
@@ -40,7 +48,8 @@ async def fetch_events(
     namespace: str,
     bodies=[],
     fetch_items=True
-) -> AsyncGenerator[Mapping[str, Any], None]:
+) -> AsyncGenerator[Tuple[Event, str], None]:
+    '''upcoming events from the api, with their agenda text'''
     yesterday = (date.today() - timedelta(days=1)).isoformat()
     filter_ = f"EventDate gt datetime'{yesterday}'"
     events = fetch_event_items(
@@ -48,74 +57,255 @@ async def fetch_events(
     )
     async for event, items in events:
         # "IN" operator not supported in odata3, so we do in code
-        if bodies and str(event['EventBodyId']) not in bodies:
+        if bodies and str(event.EventBodyId) not in bodies:
             continue
-        if fetch_items:
-            event['items'] = extract_items(items)
+        yield event, extract_items(items) if fetch_items else ''
+
+
+async def db_is_current(conn, bodies, maxage=MAXAGE) -> bool:
+    '''`legisearch sync` ran within `maxage` and the db knows every body'''
+    result = await conn.execute(
+        select(db.sync_state.c.value).where(db.sync_state.c.key == LASTSYNC)
+    )
+    synced = result.scalar()
+    if synced is None \
+            or datetime.now(tz.utc) - datetime.fromisoformat(synced) > maxage:
+        return False
+    if bodies:
+        result = await conn.execute(
+            select(db.bodies.c.id)
+            .where(db.bodies.c.id.in_([int(b) for b in bodies]))
+        )
+        return len(result.all()) == len(set(int(b) for b in bodies))
+    return True
+
+
+async def fetch_db_events(
+    namespace: str,
+    bodies=[],
+    fetch_items=True,
+    maxage: Optional[timedelta] = None,
+) -> Optional[List[Tuple[Event, str]]]:
+    '''upcoming events from the db `legisearch fetch` fills, in the shape
+    fetch_events yields them
+
+    with `maxage`, None if the db is not current, see db_is_current
+    '''
+    yesterday = datetime.combine(date.today() - timedelta(days=1),
+                                 datetime.min.time())
+    query = (
+        select(db.events, db.bodies.c.name)
+        .outerjoin(db.bodies, db.bodies.c.id == db.events.c.body_id)
+        .where(db.events.c.meeting_time > yesterday)
+        .order_by(db.events.c.meeting_time, db.events.c.id)
+    )
+    if bodies:
+        query = query.where(db.events.c.body_id.in_([int(b) for b in bodies]))
+    async with db.new_connection(namespace) as conn:
+        if maxage is not None and not await db_is_current(
+            conn, bodies, maxage
+        ):
+            return None
+        rows = (await conn.execute(query)).all()
+        items: Dict[int, List[EventItem]] = {row.id: [] for row in rows}
+        if fetch_items and items:
+            result = await conn.execute(
+                select(db.items.c.event_id, db.items.c.title,
+                       db.items.c.matter_attachments)
+                .where(db.items.c.event_id.in_(list(items)))
+                .order_by(db.items.c.event_id, db.items.c.id)
+            )
+            for item in result:
+                items[item.event_id].append(db_item(item))
+    events = []
+    for row in rows:
+        event = Event(
+            EventId=row.id,
+            # in the api's shape, which dates parses without dateutil
+            EventDate=row.meeting_time.strftime('%Y-%m-%dT00:00:00'),
+            EventTime=row.meeting_time.strftime('%I:%M %p').lstrip('0'),
+            EventLocation=row.location or 'Unknown',
+            EventBodyId=row.body_id,
+            EventBodyName=row.body_name or row.name or str(row.body_id),
+            EventAgendaFile=row.agenda_url or None,
+            EventInSiteURL=row.insite_url,
+        )
+        events.append(
+            (event, extract_items(items[row.id]) if fetch_items else '')
+        )
+    return events
+
+
+def db_item(row) -> EventItem:
+    '''an items row as the record extract_items expects'''
+    attachments = json.loads(row.matter_attachments or '{}')
+    return EventItem(
+        EventItemTitle=row.title,
+        EventItemMatterAttachments=tuple(
+            Attachment(name, url) for name, url in attachments.items()
+        ),
+    )
+
+
+async def upcoming_events(
+    namespace: str,
+    bodies=[],
+    source='auto'
+) -> AsyncGenerator[Tuple[Event, str], None]:
+    '''events and agenda text from the local db when it is current, else
+    from the api
+
+    source can be 'db' or 'api' to only use one of them, 'db' skips the
+    check of how current it is
+    '''
+    if source != 'api' and os.path.exists(db.db_file(namespace)):
+        try:
+            events = await fetch_db_events(
+                namespace, bodies, maxage=None if source == 'db' else MAXAGE
+            )
+        except SQLAlchemyError as e:
+            if source == 'db':
+                raise
+            print(f'could not read {db.db_file(namespace)}, using the api. '
+                  f'`legisearch db migrate` may fix it: {e}', file=sys.stderr)
+            events = None
+        if events is not None:
+            for event in events:
+                yield event
+            return
+    elif source == 'db':
+        raise FileNotFoundError(db.db_file(namespace))
+    async for event in fetch_events(namespace, bodies):
         yield event
 
 
-def extract_items(items: List[Mapping[str, Any]]) -> str:
+def extract_items(items: List[EventItem]) -> str:
     '''reconstruct an agenda from the event items'''
     text: List[str] = []
     for item in items:
-        if item.get('EventItemTitle'):
-            text.append(str(item['EventItemTitle']))
-        if item.get('EventItemMatterAttachments'):
-            for a in item['EventItemMatterAttachments']:
-                text.append(f"{a['MatterAttachmentName']} "
-                            f"{a['MatterAttachmentHyperlink']}")
+        if item.EventItemTitle:
+            text.append(str(item.EventItemTitle))
+        for a in item.EventItemMatterAttachments:
+            text.append(f"{a.MatterAttachmentName} "
+                        f"{a.MatterAttachmentHyperlink}")
     return '\n'.join(text)
 
 
-def event_to_ical(event, tzinfo):
-    if 'EventLocation' not in event:
-        event['EventLocation'] = 'Unknown'
-    if 'EventBodyName' not in event:
-        event['EventBodyName'] = str(event['EventBodyId'])
-    if not event['EventAgendaFile']:
-        event['EventAgendaFile'] = 'not yet posted'
-    date = datetime.fromisoformat(event['EventDate'])
-    time = parse(event['EventTime'])
-    dt = datetime.combine(date.date(), time.time(), tzinfo=tzinfo)
-    evt = Event()
-    evt.add('uid', event['EventId'])
+def event_to_ical(event: Event, agenda: str, tzinfo) -> Optional[VEvent]:
+    '''None for an event with no usable date'''
+    dt = dates.meeting_time(event.EventDate, event.EventTime, tzinfo)
+    if dt is None:
+        return None
+    event = event._replace(
+        EventLocation=event.EventLocation or 'Unknown',
+        EventBodyName=event.EventBodyName or str(event.EventBodyId),
+        EventAgendaFile=event.EventAgendaFile or 'not yet posted',
+    )
+    evt = VEvent()
+    evt.add('uid', event.EventId)
     evt.add('dtstart', dt)
     # How long are the meetings? It is unknown. Assume 2 hours?
     evt.add('dtend', dt + timedelta(hours=2))
-    evt.add('summary', event['EventBodyName'] + ' Meeting')
-    evt.add('location', event.get('EventLocation', ''))
-    evt.add('description', DESC.format_map(event))
-    if event.get('EventLastModifiedUtc'):
-        evt.add('last-modified',
-                parse(event['EventLastModifiedUtc']).replace(tzinfo=tzutc()))
+    evt.add('summary', f'{event.EventBodyName} Meeting')
+    evt.add('location', event.EventLocation)
+    evt.add('description', DESC.format(items=agenda, **event._asdict()))
+    modified = dates.parse_timestamp(event.EventLastModifiedUtc or '')
+    if modified:
+        evt.add('last-modified', modified)
     return evt
 
 
 async def gen_ical(
     namespace='mountainview',
     timezone='America/Los_Angeles',
-    bodies=None
+    bodies=None,
+    source='auto'
 ):
+    '''the calendar as one object, with the same content as stream_ical'''
     cal = Calendar()
     tzinfo = ZoneInfo(timezone)
-    bodynames = {}
-    async for event in fetch_events(namespace, bodies):
-        if bodies:
-            bodynames[event['EventBodyId']] = event['EventBodyName']
-        evt = event_to_ical(event, tzinfo)
-        cal.add_component(evt)
+    add_calendar_info(
+        cal, namespace, await body_names(namespace, bodies) if bodies else {}
+    )
+    async for event, agenda in upcoming_events(namespace, bodies, source):
+        evt = event_to_ical(event, agenda, tzinfo)
+        if evt is not None:
+            cal.add_component(evt)
     # cal.add('tzid', timezone)
-    if bodynames:
-        subtitle = ', '.join(bodynames.values())
-    desc = describe(namespace, sorted(bodynames.values()))
+    return cal
+
+
+def add_calendar_info(cal, namespace, bodynames):
+    '''sorted by name, so the same bodies in any order give the same bytes'''
+    names = sorted(bodynames.values())
+    subtitle = ', '.join(names)
+    desc = describe(namespace, names)
     calname = f'{namespace}-{subtitle}' if bodynames else namespace
     cal.add('prodid', f'-//legiscal/{calname}//en')
     cal.add('x-wr-calname', calname)
     cal.add('name', calname)
-    cal.add('x-wr-caldesc', desc)
+    # x- properties are not known to be text, so newlines are not escaped
+    cal.add('x-wr-caldesc', vText(desc))
     cal.add('description', desc)
-    return cal
+
+
+async def body_names(namespace, bodies) -> Dict[Any, str]:
+    '''names for body ids, from the local db if it knows them, else the api
+
+    ids stand in for names that can not be found
+    '''
+    names: Dict[str, str] = {}
+    if os.path.exists(db.db_file(namespace)):
+        try:
+            async with db.new_connection(namespace) as conn:
+                result = await conn.execute(select(db.bodies))
+                names = {str(row.id): row.name for row in result}
+        except SQLAlchemyError:
+            pass
+    if any(str(b) not in names for b in bodies):
+        try:
+            names.update(
+                (str(b.BodyId), b.BodyName)
+                for b in await fetch_bodies_async(namespace)
+            )
+        except httpx.HTTPError as e:
+            print(f'could not fetch body names: {e}', file=sys.stderr)
+    return {int(b): names.get(str(b), str(b)) for b in bodies}
+
+
+async def stream_ical(
+    namespace='mountainview',
+    timezone='America/Los_Angeles',
+    bodies=None,
+    source='auto'
+) -> AsyncGenerator[bytes, None]:
+    '''gen_ical as chunks of ics, one per event as soon as it is ready
+
+    the calendar's own properties go out first, so body names come from
+    the bodies endpoint instead of from the events. gen_ical does the same,
+    so either way a calendar has the same bytes
+    '''
+    tzinfo = ZoneInfo(timezone)
+    cal = Calendar()
+    add_calendar_info(
+        cal, namespace, await body_names(namespace, bodies) if bodies else {}
+    )
+    head, end, tail = cal.to_ical().rpartition(b'END:VCALENDAR')
+    yield head
+    async for event, agenda in upcoming_events(namespace, bodies, source):
+        evt = event_to_ical(event, agenda, tzinfo)
+        if evt is not None:
+            yield evt.to_ical()
+    yield end + tail
+
+
+async def render_ical(namespace, timezone='America/Los_Angeles', bodies=None,
+                      source='auto') -> bytes:
+    '''all of stream_ical at once, byte for byte what a stream sends'''
+    return b''.join([
+        chunk async for chunk in
+        stream_ical(namespace, timezone, bodies, source)
+    ])
 
 
 def describe(namespace, bodies):
@@ -125,6 +315,13 @@ def describe(namespace, bodies):
     )
 
 
+def body_id(value: str) -> str:
+    '''body ids stay strings, event body ids are compared as strings'''
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(f'not a body id: {value}')
+    return value
+
+
 def parser() -> argparse.ArgumentParser:
     '''Command line useage definitions'''
     parser = argparse.ArgumentParser(
@@ -147,8 +344,18 @@ def parser() -> argparse.ArgumentParser:
         '-b', '--bodyid',
         help='only show selected meeting body events',
         nargs='*',
+        type=body_id,
         default=[]
     )
+
+    parser.add_argument(
+        '-s', '--source',
+        help='where events come from. auto uses NAMESPACE.db from '
+        '`legisearch fetch` when `legisearch sync` kept it current, '
+        'else the api',
+        choices=('auto', 'db', 'api'),
+        default='auto'
+    )
     return parser
 
 
@@ -156,7 +363,11 @@ async def main(args=None):
     if args is None:
         args = sys.argv[1:]
     cmd = parser().parse_args(args)
-    cal = await gen_ical(cmd.namespace, cmd.timezone, cmd.bodyid)
+    try:
+        cal = await gen_ical(cmd.namespace, cmd.timezone, cmd.bodyid,
+                             cmd.source)
+    finally:
+        await db.dispose_engines()
     return cal.to_ical().decode('utf8')
 
 
@@ -20,7 +20,7 @@ async function bodySelect(namespace, parentEl) {
     ['name', 'id', 'value'].forEach((id) => input.setAttribute(id, bodies[bodyName]));
     parentEl.appendChild(input);
     const label = document.createElement('label');
-    lable.textContent = bodyName;
+    label.textContent = bodyName;
     label.setAttribute('for', bodies[bodyName]);
     parentEl.appendChild(label);
   }
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''append-only archive of everything fetch and sync got from legistar
+
+Each event is written with its items exactly as the api returned them,
+before format_event touches them, one json object per line in
+NAMESPACE.archive.ndjson.gz. Body lists are archived too. `legisearch
+rebuild` replays the file into a new db, so a change to format_event or
+the schema needs no re-download.
+
+Every run appends a new gzip member, gzip reads them back as one stream.
+A run killed mid-write leaves a truncated last member, reading stops there.
+
+Set `LEGISEARCH_ARCHIVE` to an empty string to stop archiving.
+'''
+
+from typing import Any, Dict, Iterator, List, Mapping, Optional, TextIO, \
+    Tuple
+from datetime import datetime, timezone
+import os
+import re
+import sys
+import zlib
+import gzip
+import json
+from legisearch.models import Event, EventItem, Body
+
+ENABLED = os.environ.get('LEGISEARCH_ARCHIVE', '1') != ''
+# json.dumps keeps key order, so event lines start with their id
+EVENTID = re.compile(r'\{"id": (\d+),')
+
+
+def archive_file(namespace: str) -> str:
+    return f'{namespace}.archive.ndjson.gz'
+
+
+class Archive:
+    '''appends to the namespace's archive while open
+
+        with Archive(namespace) as archive:
+            archive.add(event, items)
+    '''
+
+    def __init__(self, namespace: str, enabled: Optional[bool] = None):
+        self.path = archive_file(namespace)
+        self.enabled = ENABLED if enabled is None else enabled
+        self.file: Optional[TextIO] = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.file = gzip.open(self.path, 'at', encoding='utf-8')
+        return self
+
+    def __exit__(self, *exc):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def write(self, record: Mapping[str, Any]):
+        if self.file:
+            self.file.write(json.dumps(record) + '\n')
+
+    def add(self, event: Event, items: List[EventItem]):
+        self.write({
+            'id': event.EventId,
+            'fetched': now(),
+            'event': event.to_api(),
+            'items': [item.to_api() for item in items],
+        })
+
+    def add_bodies(self, bodies: List[Body]):
+        self.write({
+            'bodies': [body.to_api() for body in bodies],
+            'fetched': now(),
+        })
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def read(namespace: str) -> Iterator[Tuple[int, str]]:
+    '''(line number, line) for every archived record'''
+    with gzip.open(archive_file(namespace), 'rt', encoding='utf-8') as f:
+        lineno = 0
+        try:
+            for lineno, line in enumerate(f):
+                yield lineno, line
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            print(f'archive is cut short after line {lineno}, ignoring the '
+                  f'rest: {e!r}', file=sys.stderr)
+
+
+def records(line: str) -> Tuple[Event, List[EventItem]]:
+    '''the event and items of an archived event line'''
+    record = json.loads(line)
+    return (Event.from_api(record['event']),
+            [EventItem.from_api(item) for item in record['items']])
+
+
+def latest(namespace: str) -> Tuple[Dict[int, int], Optional[List[Body]]]:
+    '''line number of the newest copy of each event, and the newest body list
+
+    sync archives an event again every time it changes, only the last
+    copy is replayed
+    '''
+    lines: Dict[int, int] = {}
+    bodies = None
+    for lineno, line in read(namespace):
+        match = EVENTID.match(line)
+        if match:
+            lines[int(match.group(1))] = lineno
+        elif line.startswith('{"bodies"'):
+            bodies = [Body.from_api(b) for b in json.loads(line)['bodies']]
+    return lines, bodies
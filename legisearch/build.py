@@ -1,5 +1,16 @@
 #!/usr/bin/env python
 
+from typing import Any, Dict, Iterator, List, Sequence
+from collections import defaultdict
+import sys
+import sqlite3
+from legisearch.legistar import fetch_bodies
+
+BATCHSIZE = 500  # rows read from sqlite at a time
+ITEMCOLUMNS = ('id', 'eventid', 'agendanumber', 'actiontext', 'title',
+               'matterid', 'matterattachments', 'matterstatus', 'mattertype',
+               'mattertext')
+
 
 def create_tables(connection):
     connection.cursor().execute('''
@@ -38,21 +49,40 @@ def create_tables(connection):
     connection.commit()
 
 
-def data_from_db(connection):
-    '''all gathered data from the sqlite db'''
+def rows(connection, query: str, batch_size=BATCHSIZE) -> Iterator[Any]:
+    '''rows of `query`, fetched `batch_size` at a time not all at once'''
+    cursor = connection.execute(query)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield from batch
+
+
+def data_from_db(
+    connection,
+    item_columns: Sequence[str] = ITEMCOLUMNS,
+    batch_size=BATCHSIZE,
+):
+    '''all gathered data from the sqlite db
+
+    items are grouped by lowercased title, each keeps only `item_columns`
+    '''
     connection.row_factory = sqlite3.Row
-    cursor = connection.cursor()
-    cursor.execute('SELECT DISTINCT title FROM items')
-    items: Mapping[str, List[Mapping[str, Any]]] = {
-        r[0].lower(): [] for r in cursor.fetchall() if r[0]}
-    cursor.execute('SELECT * FROM items WHERE title IS NOT NULL')
-    for row in cursor.fetchall():
-        items[row['title'].lower()].append({k: row[k] for k in row.keys()})
-    cursor.execute('SELECT * FROM events')
-    events = {e['id']: dict(**e) for e in cursor.fetchall()}
-    cursor.execute('SELECT id, name FROM bodies')
-    bodies = {r['id']: r['name'] for r in cursor.fetchall()}
-    return items, events, bodies
+    items: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    query = f'''SELECT title, {", ".join(item_columns)} FROM items
+        WHERE title IS NOT NULL'''
+    for title, *values in rows(connection, query, batch_size):
+        items[title.lower()].append(dict(zip(item_columns, values)))
+    events = {
+        e['id']: dict(e)
+        for e in rows(connection, 'SELECT * FROM events', batch_size)
+    }
+    bodies = {
+        r['id']: r['name']
+        for r in rows(connection, 'SELECT id, name FROM bodies', batch_size)
+    }
+    return dict(items), events, bodies
 
 
 def insert_events(connection, events):
@@ -106,6 +136,6 @@ def fetch_and_insert_bodies(namespace: str, connection):
     bodies = fetch_bodies(namespace)
     connection.cursor().executemany(
         'INSERT INTO bodies VALUES (?, ?)',
-        ((b['BodyId'], b['BodyName']) for b in bodies)
+        ((b.BodyId, b.BodyName) for b in bodies)
     )
     connection.commit()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+'''on-disk cache for legistar api responses
+
+Most of what we pull from legistar (body lists, items of old meetings,
+matters) never changes, so responses are kept in a small sqlite file and
+served from there until their ttl runs out. Stale entries are revalidated
+with If-None-Match / If-Modified-Since when the server gave us an etag or
+last-modified header, otherwise they are just fetched again.
+
+The cache plugs in as an httpx transport, so anything using a client from
+`legistar.new_client` gets it for free.
+'''
+
+from typing import Optional, NamedTuple, Tuple
+from urllib.parse import urlencode
+import os
+import re
+import time
+import zlib
+import sqlite3
+import threading
+import httpx
+from legisearch import metrics
+
+
+CACHEFILE = os.environ.get('LEGISEARCH_CACHE', 'legistar-cache.db')
+MAXBYTES = 256 * 1024 * 1024  # compressed bytes before old entries go
+HOUR = 3600
+# how long a response stays fresh, first matching path pattern wins
+TTLS: Tuple[Tuple[str, float], ...] = (
+    (r'/bodies$', 7 * 24 * HOUR),
+    (r'/events/\d+/eventitems$', 6 * HOUR),
+    (r'/events$', HOUR / 6),
+    (r'/eventitems/\d+/', 24 * HOUR),  # votes and rollcalls
+    (r'/matters/', 24 * HOUR),
+)
+DEFAULTTTL = HOUR
+KEPTHEADERS = ('content-type', 'etag', 'last-modified')
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS responses(
+    key text PRIMARY KEY,
+    stored real NOT NULL,
+    accessed real NOT NULL,
+    ttl real NOT NULL,
+    etag text,
+    last_modified text,
+    content_type text,
+    body blob NOT NULL)
+'''
+
+
+class Entry(NamedTuple):
+    key: str
+    stored: float
+    ttl: float
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_type: Optional[str]
+    body: bytes
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() - self.stored < self.ttl
+
+    def response(self, request: httpx.Request) -> httpx.Response:
+        headers = {}
+        if self.content_type:
+            headers['content-type'] = self.content_type
+        return httpx.Response(
+            200,
+            headers=headers,
+            content=zlib.decompress(self.body),
+            request=request,
+        )
+
+
+def cache_key(request: httpx.Request) -> str:
+    '''url with the query params sorted, so param order does not matter'''
+    url = request.url
+    query = urlencode(sorted(url.params.multi_items()))
+    return f'{url.scheme}://{url.host}{url.path}?{query}'
+
+
+def ttl_for(request: httpx.Request) -> float:
+    path = request.url.path.lower()
+    for pattern, ttl in TTLS:
+        if re.search(pattern, path):
+            return ttl
+    return DEFAULTTTL
+
+
+class ResponseCache:
+    '''sqlite backed LRU store of response bodies
+
+    One instance is shared by every client in the process. sqlite calls are
+    quick enough to make from the event loop, the lock is for flask worker
+    threads.
+    '''
+
+    def __init__(self, path=CACHEFILE, maxbytes=MAXBYTES):
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(SCHEMA)
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed '
+            'ON responses(accessed)'
+        )
+        self.size, = self.conn.execute(
+            'SELECT coalesce(sum(length(body)), 0) FROM responses'
+        ).fetchone()
+
+    def get(self, request: httpx.Request) -> Optional[Entry]:
+        key = cache_key(request)
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT key, stored, ttl, etag, last_modified, content_type, '
+                'body FROM responses WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                (time.time(), key)
+            )
+            self.conn.commit()
+        return Entry(*row)
+
+    def revalidate(self, request: httpx.Request, entry: Entry):
+        '''ask the server to only send the body if it changed'''
+        if entry.etag:
+            request.headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            request.headers['If-Modified-Since'] = entry.last_modified
+
+    def refresh(self, entry: Entry):
+        '''server says not modified, restart the ttl'''
+        with self.lock:
+            self.conn.execute(
+                'UPDATE responses SET stored = ? WHERE key = ?',
+                (time.time(), entry.key)
+            )
+            self.conn.commit()
+
+    def store(
+        self,
+        request: httpx.Request,
+        response: httpx.Response,
+        content: bytes,
+    ) -> httpx.Response:
+        '''save the body and return a response that can be read again'''
+        headers = {
+            k: response.headers[k] for k in KEPTHEADERS if k in response.headers
+        }
+        body = zlib.compress(content)
+        now = time.time()
+        key = cache_key(request)
+        with self.lock:
+            old = self.conn.execute(
+                'SELECT length(body) FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?)',
+                (key, now, now, ttl_for(request), headers.get('etag'),
+                 headers.get('last-modified'), headers.get('content-type'),
+                 body)
+            )
+            self.size += len(body) - (old[0] if old else 0)
+            if self.size > self.maxbytes:
+                self.evict()
+            self.conn.commit()
+        return httpx.Response(
+            response.status_code,
+            headers=headers,
+            content=content,
+            request=request,
+        )
+
+    def evict(self):
+        '''drop least recently used entries until we are back under 90%'''
+        target = self.maxbytes * 0.9
+        rows = self.conn.execute(
+            'SELECT key, length(body) FROM responses ORDER BY accessed'
+        )
+        doomed = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            doomed.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM responses')
+            self.conn.commit()
+            self.size = 0
+
+
+class AsyncCacheTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        cache: ResponseCache,
+    ):
+        self.transport = transport
+        self.cache = cache
+
+    async def handle_async_request(
+        self,
+        request: httpx.Request,
+    ) -> httpx.Response:
+        if request.method != 'GET':
+            return await self.transport.handle_async_request(request)
+        entry = self.cache.get(request)
+        if entry and entry.fresh:
+            metrics.CACHE.inc(result='hit')
+            return entry.response(request)
+        if entry:
+            self.cache.revalidate(request, entry)
+        response = await self.transport.handle_async_request(request)
+        if entry and response.status_code == 304:
+            metrics.CACHE.inc(result='revalidated')
+            await response.aclose()
+            self.cache.refresh(entry)
+            return entry.response(request)
+        metrics.CACHE.inc(result='miss')
+        if response.status_code != 200:
+            return response
+        return self.cache.store(request, response, await response.aread())
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def response_cache() -> Optional[ResponseCache]:
+    '''the process wide cache, or None if LEGISEARCH_CACHE is set to ""'''
+    global _cache
+    if _cache is None and CACHEFILE:
+        _cache = ResponseCache(CACHEFILE)
+    return _cache
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
+from typing import Tuple
 import sys
 import json
 import asyncio
 import argparse
-from sqlalchemy import select
-from legisearch import db
-from legisearch.fetch import fetch_more_events, setup_db, insert_bodies
-from legisearch.search import search
+from datetime import date
+from sqlalchemy import select, func
+from legisearch import db, ratelimit, metrics
+from legisearch.legistar import CONCURRENCY, KNOWN_NAMESPACES
+from legisearch.fetch import fetch_more_events, fetch_namespaces, \
+    sync_events, rebuild, setup_db, insert_bodies, SYNCDAYS, BATCHSIZE
+from legisearch.export import FORMATS, export, brotli
+from legisearch.search import search, search_query, all_minutes_query, \
+    cursor, default_order, ORDERS
 
 
 def parser() -> argparse.ArgumentParser:
@@ -24,6 +30,11 @@ def parser() -> argparse.ArgumentParser:
         help='legistar api subdomain and db name',
         default='mountainview'
     )
+    parent.add_argument(
+        '--stats',
+        help='print request, parsing and db timings when done',
+        action='store_true'
+    )
     subparsers = root_parser.add_subparsers(
         required=True,
         dest='command',
@@ -42,11 +53,101 @@ def parser() -> argparse.ArgumentParser:
         default=50
     )
     fetch_parser.add_argument(
-        '--refetch-nonfinal',
-        help='re-fetch events which did not have final minutes',
+        '-c', '--concurrency',
+        help='max number of eventitems requests in flight at once',
+        type=int,
+        default=CONCURRENCY
+    )
+    fetch_parser.add_argument(
+        '--fetch-matter-text',
+        help='also fetch matter details (histories, sponsors, etc). '
+             'only kept in the archive, the db does not store them',
+        action='store_true'
+    )
+    fetch_parser.add_argument(
+        '--fetch-item-extra',
+        help='also fetch votes and roll calls for each item. '
+             'only kept in the archive, the db does not store them',
         action='store_true'
     )
-    fetch_parser.set_defaults(func=fetch_more_events)
+    fetch_parser.add_argument(
+        '--no-cache',
+        help='always go to the api, ignoring the on-disk response cache',
+        dest='cache',
+        action='store_false'
+    )
+    fetch_parser.add_argument(
+        '--batch-size',
+        help='number of events to insert and commit at a time',
+        type=int,
+        default=BATCHSIZE
+    )
+    fetch_parser.add_argument(
+        '--namespaces',
+        help='comma separated namespaces to fetch at the same time',
+    )
+    fetch_parser.add_argument(
+        '--all-known',
+        help='fetch every known namespace at the same time',
+        action='store_true'
+    )
+    fetch_parser.add_argument(
+        '--rate',
+        help='max requests per second to the legistar api, all namespaces '
+             'together',
+        type=float,
+        default=ratelimit.RATE
+    )
+    fetch_parser.set_defaults(func=fetch)
+
+    sync_parser = subparsers.add_parser(
+        'sync',
+        parents=[parent],
+        help='re-fetch events and items changed since the last sync'
+    )
+    sync_parser.add_argument(
+        '-c', '--concurrency',
+        help='max number of eventitems requests in flight at once',
+        type=int,
+        default=CONCURRENCY
+    )
+    sync_parser.add_argument(
+        '-d', '--days',
+        help='check items of events from this many days back '
+             'without final minutes',
+        type=int,
+        default=SYNCDAYS
+    )
+    sync_parser.add_argument(
+        '--batch-size',
+        help='number of events to insert and commit at a time',
+        type=int,
+        default=BATCHSIZE
+    )
+    sync_parser.set_defaults(func=sync_events)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild',
+        parents=[parent],
+        help='recreate the db from the archive of fetched events, offline'
+    )
+    rebuild_parser.add_argument(
+        '-j', '--jobs',
+        help='worker processes formatting events. default: one per cpu',
+        type=int,
+    )
+    rebuild_parser.add_argument(
+        '--batch-size',
+        help='number of events to format and insert at a time',
+        type=int,
+        default=BATCHSIZE
+    )
+    rebuild_parser.add_argument(
+        '--force',
+        help='replace the db even if it has events the archive does not',
+        action='store_true'
+    )
+    rebuild_parser.set_defaults(func=rebuild)
 
     reset_parser = subparsers.add_parser(
         'reset',
@@ -65,11 +166,21 @@ def parser() -> argparse.ArgumentParser:
     generate_parser = subparsers.add_parser(
         'generate',
         parents=[parent],
-        help='generate the static search html page'
+        help='export json shards for the static search page'
+    )
+    generate_parser.add_argument(
+        '-o', '--outdir',
+        help='directory to write the manifest and shards to',
+        default='static_web'
     )
     generate_parser.add_argument(
-        '-o', '--outfile',
-        help='name of the html page to generate',
+        '-f', '--format',
+        dest='fmt',
+        choices=FORMATS,
+        help='rows: an array of item objects per shard, compact: column '
+        'arrays with a string table, smaller but needs decoding. '
+        'default: %(default)s',
+        default='rows'
     )
     generate_parser.set_defaults(func=generate)
 
@@ -90,17 +201,90 @@ def parser() -> argparse.ArgumentParser:
         '-y', '--year',
         help='limit to specific year',
     )
+    search_parser.add_argument(
+        '-m', '--month',
+        help='limit to specific month, needs --year',
+    )
+    search_parser.add_argument(
+        '-l', '--limit',
+        help='max number of results, prints a cursor for the next page',
+        type=int,
+    )
+    search_parser.add_argument(
+        '--after',
+        help='cursor printed at the end of the previous page',
+    )
+    search_parser.add_argument(
+        '--order',
+        choices=ORDERS,
+        help='default: rank when searching with --query, else newest',
+    )
     search_parser.set_defaults(func=do_search)
 
+    db_parser = subparsers.add_parser(
+        'db',
+        parents=[parent],
+        help='database maintenance'
+    )
+    db_parser.add_argument(
+        'action',
+        help='migrate: add any missing tables and indexes, and index items '
+             'missing from the full text index. '
+             'analyze: update sqlite statistics and show query plans',
+        choices=('migrate', 'analyze'),
+    )
+    db_parser.set_defaults(func=dbadmin)
+
     return root_parser
 
 
-async def do_search(namespace, query=None, body=None, year=None):
-    columns = ('body_id', 'meeting_time', 'matter_type', 'agenda_number',
-               'title', 'action_text')
+async def fetch(
+    namespace,
+    namespaces=None,
+    all_known=False,
+    rate=ratelimit.RATE,
+    **kwargs
+):
+    ratelimit.configure(rate=rate)
+    if all_known:
+        await fetch_namespaces(list(KNOWN_NAMESPACES.values()), **kwargs)
+    elif namespaces:
+        await fetch_namespaces(namespaces.split(','), **kwargs)
+    else:
+        await fetch_more_events(namespace, **kwargs)
+
+
+async def do_search(
+    namespace,
+    query=None,
+    body=None,
+    year=None,
+    month=None,
+    limit=None,
+    after=None,
+    order=None,
+):
+    columns: Tuple[str, ...] = ('body_id', 'meeting_time', 'matter_type',
+                                'agenda_number', 'title', 'action_text')
+    if query:
+        columns += ('snippet',)
+    order = default_order(query, order)
     print('|'.join(columns))
-    async for result in search(namespace, search_string=query, body=body, year=year):
-        print('|'.join(str(result[col]) for col in columns))
+    results = search(
+        namespace, search_string=query, body=body, year=year, month=month,
+        columns=columns, order=order, after=after, limit=limit,
+    )
+    count, last = 0, None
+    try:
+        async for result in results:
+            print('|'.join(str(result[col]) for col in columns))
+            count, last = count + 1, result
+    finally:
+        # close the db cursor now, not whenever the generator is collected
+        await results.aclose()
+    if limit and count == limit:
+        print(f'next page: --order {order} --after {cursor(last, order)}',
+              file=sys.stderr)
 
 
 async def bodies(namespace):
@@ -115,6 +299,28 @@ async def bodies(namespace):
     json.dump(bodies, sys.stdout)
 
 
+async def dbadmin(namespace, action):
+    async with db.new_connection(namespace) as conn:
+        await db.create_tables(namespace, conn, backfill=action == 'migrate')
+        if action == 'migrate':
+            print(f'{namespace} db is up to date')
+            return
+        await conn.exec_driver_sql('ANALYZE')
+        result = await conn.execute(select(func.min(db.events.c.body_id)))
+        body_id, = result.fetchone()
+        queries = {
+            'search': search_query(
+                'council', body=body_id, year=date.today().year
+            ),
+            'all_minutes': all_minutes_query(body_id),
+            'newest page': search_query(body=body_id, limit=20),
+        }
+        for name, query in queries.items():
+            print(f'{name}:')
+            for step in await db.explain(conn, query):
+                print(f'  {step}')
+
+
 async def reset(
     namespace: str,
 ):
@@ -125,24 +331,35 @@ async def reset(
 
 async def generate(
     namespace: str,
-    outfile=None,
+    outdir='static_web',
+    fmt='rows',
 ):
-    '''generate a all-in-one search webpage with our data embedded in
-
-    Generated file is about 7.5M
-    '''
-    print('TODO: remake the generate fuction')
+    '''export the db as per body, per year json shards plus a manifest'''
+    manifest = await export(namespace, outdir, fmt)
+    shards = manifest['shards']
+    print(f'wrote {sum(s["items"] for s in shards)} items in {len(shards)} '
+          f'shards to {outdir}/{namespace}')
+    if not brotli:
+        print('brotli is not installed, only .gz copies were written')
 
 
 async def parse_and_run():
-    args = vars(parser().parse_args())
+    root_parser = parser()
+    args = vars(root_parser.parse_args())
+    if args.get('month') and not args.get('year'):
+        root_parser.error('--month needs --year')
     func = args.pop('func')
     command = args.pop('command')
+    stats = args.pop('stats')
     try:
         await func(**args)
     except Exception:
         print(f'failed to run {command} with {args}', file=sys.stderr)
         raise
+    finally:
+        await db.dispose_engines()
+        if stats:
+            print(metrics.registry.summary(), file=sys.stderr)
 
 
 def main():
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''parsing legistar's dates and times
+
+Legistar sends dates as "2017-09-12T00:00:00", times of day as "1:30 PM"
+and modification stamps as "2017-08-08T14:08:58.68" in UTC. Those shapes
+are parsed with a regex, dateutil is only tried for anything else.
+A namespace only uses a handful of distinct time strings, so those are
+memoized.
+
+Legistar has no time zones, meeting times are local to the city. They are
+returned in the namespace's zone, see `namespace_zone`. The db keeps the
+wall clock time.
+'''
+
+from typing import Iterable, List, Optional
+from datetime import date, datetime, time, timezone, tzinfo
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import os
+import re
+from dateutil.parser import parse
+from legisearch.models import Event
+
+# every city in legistar.KNOWN_NAMESPACES is in santa clara county
+TIMEZONE = os.environ.get('LEGISEARCH_TIMEZONE', 'America/Los_Angeles')
+NOON = time(12)
+TIME = re.compile(
+    r'\s*(\d{1,2})(?::(\d\d))?(?::(\d\d))?\s*(?:([AaPp])\.?\s*[Mm]\.?)?\s*'
+)
+DATE = re.compile(r'\d{4}-\d\d-\d\d(?:[T ]00:00(?::00)?)?')
+TIMESTAMP = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?Z?'
+)
+
+
+@lru_cache(maxsize=None)
+def namespace_zone(namespace: str) -> tzinfo:
+    return ZoneInfo(TIMEZONE)
+
+
+@lru_cache(maxsize=1024)
+def parse_time(text: str) -> Optional[time]:
+    '''"7:00 PM" -> 19:00, None if it is not a time at all'''
+    match = TIME.fullmatch(text)
+    if match:
+        hour, minute, second, half = match.groups()
+        hour, minute, second = int(hour), int(minute or 0), int(second or 0)
+        if half and 1 <= hour <= 12:
+            hour = hour % 12 + (12 if half in 'Pp' else 0)
+            half = None
+        if not half and hour < 24 and minute < 60 and second < 60:
+            return time(hour, minute, second)
+    try:
+        return parse(text).time()
+    except (ValueError, OverflowError):
+        print(f'failed to parse time {text!r}')
+        return None
+
+
+@lru_cache(maxsize=4096)
+def parse_date(text: str) -> Optional[date]:
+    '''the day of an EventDate'''
+    if DATE.fullmatch(text):
+        return date.fromisoformat(text[:10])
+    try:
+        return parse(text).date()
+    except (ValueError, OverflowError):
+        print(f'failed to parse date {text!r}')
+        return None
+
+
+def parse_timestamp(text: str) -> Optional[datetime]:
+    '''a *LastModifiedUtc field as an aware UTC datetime'''
+    match = TIMESTAMP.fullmatch(text)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return datetime(
+            int(year), int(month), int(day), int(hour), int(minute),
+            int(second or 0), int((fraction or '0').ljust(6, '0')),
+            tzinfo=timezone.utc,
+        )
+    try:
+        stamp = parse(text)
+    except (ValueError, OverflowError):
+        return None
+    if stamp.tzinfo is None:
+        return stamp.replace(tzinfo=timezone.utc)
+    return stamp.astimezone(timezone.utc)
+
+
+def meeting_time(
+    date_text: Optional[str],
+    time_text: Optional[str],
+    tz: Optional[tzinfo] = None,
+) -> Optional[datetime]:
+    '''EventDate and EventTime as one datetime in `tz`
+
+    meetings without a usable time are put at noon, None without a date
+    '''
+    day = parse_date(date_text) if date_text else None
+    if day is None:
+        return None
+    hour = parse_time(time_text) if time_text else None
+    if hour is None:
+        hour = NOON
+    return datetime.combine(day, hour, tzinfo=tz)
+
+
+def meeting_times(
+    events: Iterable[Event],
+    tz: Optional[tzinfo] = None,
+) -> List[Optional[datetime]]:
+    '''meeting_time for a page of events
+
+    each distinct date and time string is parsed once, and each distinct
+    pair combined once
+    '''
+    combined = {}
+    times = []
+    for event in events:
+        key = event.EventDate, event.EventTime
+        if key not in combined:
+            combined[key] = meeting_time(*key, tz)
+        times.append(combined[key])
+    return times
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from typing import Dict
 from contextlib import asynccontextmanager
+from weakref import WeakKeyDictionary
+import time
+import asyncio
 from sqlalchemy import Table, Column, MetaData, Integer, DateTime, \
-    Text, UniqueConstraint
-from sqlalchemy.ext.asyncio import create_async_engine
+    Text, UniqueConstraint, Index, DDL, event, table, column, inspect
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from legisearch import metrics
 
 
 meta = MetaData()
@@ -17,7 +22,14 @@ events = Table(
     Column('minutes_url', Text),
     Column('minutes_status', Integer),
     Column('insite_url', Text),
-    UniqueConstraint('id', sqlite_on_conflict='REPLACE')
+    Column('location', Text),
+    Column('body_name', Text),
+    UniqueConstraint('id', sqlite_on_conflict='REPLACE'),
+    # id is included so a range of these gives the events to join items on
+    # in (meeting_time, id) order, the columns selected still come from
+    # the table
+    Index('events_body_time', 'body_id', 'meeting_time', 'id'),
+    Index('events_time', 'meeting_time', 'id'),
 )
 items = Table(
     'items',
@@ -32,7 +44,8 @@ items = Table(
     Column('matter_status', Text),
     Column('matter_attachments', Text),
     Column('matter_type', Text),
-    UniqueConstraint('id', sqlite_on_conflict='REPLACE')
+    UniqueConstraint('id', sqlite_on_conflict='REPLACE'),
+    Index('items_event', 'event_id', 'id'),
 )
 bodies = Table(
     'bodies',
@@ -41,6 +54,45 @@ bodies = Table(
     Column('name', Text, nullable=False),
     UniqueConstraint('id', sqlite_on_conflict='REPLACE')
 )
+# high-water marks for `legisearch sync`, keyed on the legistar field name,
+# and when it last ran
+sync_state = Table(
+    'sync_state',
+    meta,
+    Column('key', Text, nullable=False),
+    Column('value', Text),
+    UniqueConstraint('key', sqlite_on_conflict='REPLACE')
+)
+
+# full text index over items, rowid is items.id
+# sqlalchemy can not create virtual tables, so it is managed with raw DDL
+# and kept in sync by triggers, which also catch the REPLACE on items.id
+FTSCOLUMNS = ('title', 'action_text', 'matter_type', 'agenda_number')
+FTSWEIGHTS = (10.0, 5.0, 2.0, 1.0)  # bm25 weights, in FTSCOLUMNS order
+items_fts = table('items_fts', column('rowid'), *map(column, FTSCOLUMNS))
+_ftscols = ', '.join(FTSCOLUMNS)
+_ftsnew = ', '.join(f'new.{c}' for c in FTSCOLUMNS)
+for ddl in (
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS items_fts
+    USING fts5({_ftscols}, tokenize='porter unicode61')''',
+    f'''CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items
+    BEGIN
+        INSERT OR REPLACE INTO items_fts(rowid, {_ftscols})
+        VALUES (new.id, {_ftsnew});
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items
+    BEGIN
+        DELETE FROM items_fts WHERE rowid = old.id;
+    END''',
+):
+    event.listen(meta, 'after_create', DDL(ddl))
+event.listen(meta, 'before_drop', DDL('DROP TABLE IF EXISTS items_fts'))
+# index anything inserted before the index existed, or left out by a
+# migration that was interrupted part way. it reads all of items, so it only
+# runs when items_fts is new or from `legisearch db migrate`
+FTSBACKFILL = f'''INSERT INTO items_fts(rowid, {_ftscols})
+    SELECT id, {_ftscols} FROM items
+    WHERE id NOT IN (SELECT rowid FROM items_fts)'''
 
 
 async def recreate_tables(namespace, conn):
@@ -48,28 +100,182 @@ async def recreate_tables(namespace, conn):
     await conn.run_sync(meta.create_all)
 
 
-async def create_tables(namespace, conn=None):
+def _migrate(sync_conn, backfill=False):
+    '''create_all only adds indexes and columns along with new tables'''
+    backfill = backfill or not inspect(sync_conn).has_table('items_fts')
+    meta.create_all(sync_conn)
+    if backfill:
+        sync_conn.exec_driver_sql(FTSBACKFILL)
+    inspector = inspect(sync_conn)
+    for tbl in meta.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(tbl.name)}
+        for col in tbl.columns:
+            if col.name not in existing:
+                coltype = col.type.compile(dialect=sync_conn.dialect)
+                sync_conn.exec_driver_sql(
+                    f'ALTER TABLE {tbl.name} ADD COLUMN {col.name} {coltype}'
+                )
+    for tbl in meta.sorted_tables:
+        for index in tbl.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def create_tables(namespace, conn=None, backfill=False):
+    '''create anything missing, safe to run against an existing db
+
+    `backfill` indexes items missing from items_fts, see FTSBACKFILL
+    '''
     if conn:
-        await conn.run_sync(meta.create_all)
+        await conn.run_sync(_migrate, backfill)
     else:
         async with new_connection(namespace) as conn:
-            await conn.run_sync(meta.create_all)
+            await conn.run_sync(_migrate, backfill)
+
+
+STREAMBATCH = 500  # rows fetched at a time by `stream`
+
+
+async def stream(conn, query, batch_size=STREAMBATCH):
+    '''an unbuffered result for `query`, rows are read `batch_size` at a time
+
+    memory use does not grow with the number of rows
+    '''
+    return await conn.stream(query.execution_options(yield_per=batch_size))
+
+
+# rows of each index `analyze` looks at, plenty for the planner's choices
+ANALYSISLIMIT = 1000
+
+
+async def analyze(conn):
+    '''refresh sqlite's statistics, quick enough to run after every write
+
+    without them sqlite drives meeting time searches from items rather
+    than the events_time index, and sorts every item for the first page
+    '''
+    await conn.exec_driver_sql(f'PRAGMA analysis_limit={ANALYSISLIMIT}')
+    await conn.exec_driver_sql('ANALYZE')
+    # the connection goes back to the pool, a later full ANALYZE is full
+    await conn.exec_driver_sql('PRAGMA analysis_limit=0')
+
+
+async def explain(conn, query):
+    '''sqlite's query plan for a sqlalchemy select, one line per step'''
+    compiled = query.compile(conn.sync_connection)
+    params = tuple(compiled.params[k] for k in compiled.positiontup)
+    result = await conn.exec_driver_sql(
+        f'EXPLAIN QUERY PLAN {compiled}', params
+    )
+    return [row[-1] for row in result]
+
+
+# WAL lets searches read while a fetch is writing, and with it NORMAL
+# sync is still safe against corruption, it only risks the last commit
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # negative is KiB, so 64MB
+    'temp_store': 'MEMORY',
+}
+
+
+def set_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for pragma, value in PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+
+def before_execute(conn, cursor, statement, params, context, executemany):
+    # kept on the statement's own context rather than the connection, so
+    # a statement that fails leaves no start time behind
+    if context is not None:
+        context.started = time.perf_counter()
+
+
+def after_execute(conn, cursor, statement, params, context, executemany):
+    started = getattr(context, 'started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    kind = statement.lstrip().split(None, 1)[0].lower()
+    metrics.SQL_SECONDS.observe(elapsed, statement=kind)
+
+
+# passed to create_async_engine, change with `configure_pool`
+POOL = {
+    'pool_size': 5,
+    'max_overflow': 10,
+}
+# aiosqlite connections belong to the loop that opened them, so engines are
+# cached per loop. Nothing disposes them when their loop finishes, their
+# connections and threads leak unless `dispose_engines` runs first. Run
+# many short loops through one long lived one, as legiscal.background does.
+_engines: (
+    'WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncEngine]]'
+) = WeakKeyDictionary()
+
+
+def configure_pool(**options):
+    '''set pool options for engines created from now on'''
+    POOL.update(options)
+
+
+def db_file(namespace) -> str:
+    return f'{namespace}.db'
 
 
 def create_engine(namespace):
-    engine = create_async_engine(f'sqlite+aiosqlite:///{namespace}.db')
+    engine = create_async_engine(
+        f'sqlite+aiosqlite:///{db_file(namespace)}', **POOL
+    )
+    event.listen(engine.sync_engine, 'connect', set_pragmas)
+    event.listen(engine.sync_engine, 'before_cursor_execute', before_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', after_execute)
     return engine
 
 
+def get_engine(namespace) -> AsyncEngine:
+    '''the shared engine for `namespace`, created on first use'''
+    engines = _engines.setdefault(asyncio.get_running_loop(), {})
+    if namespace not in engines:
+        engines[namespace] = create_engine(namespace)
+    return engines[namespace]
+
+
+async def dispose_engines():
+    '''close every pooled connection opened from the running loop
+
+    call before the loop shuts down, eg at the end of a cli command
+    '''
+    engines = _engines.pop(asyncio.get_running_loop(), {})
+    for engine in engines.values():
+        await engine.dispose()
+
+
 @asynccontextmanager
-async def new_connection(namespace):
-    engine = create_engine(namespace)
-    async with engine.begin() as conn:
-        yield conn
-    await engine.dispose()
+async def new_connection(namespace, begin=True):
+    '''connection wrapped in a single transaction
+
+    `begin=False` gives a commit-as-you-go connection instead, for writers
+    that commit in batches. Whatever is left uncommitted is committed on a
+    clean exit.
+    '''
+    engine = get_engine(namespace)
+    if begin:
+        async with engine.begin() as conn:
+            yield conn
+    else:
+        async with engine.connect() as conn:
+            yield conn
+            await conn.commit()
 
 
 if __name__ == '__main__':
-    import sys, asyncio
+    import sys
+
+    async def main(namespace):
+        await create_tables(namespace)
+        await dispose_engines()
     args = sys.argv + ['mountainview']
-    asyncio.run(create_tables(args[1]))
+    asyncio.run(main(args[1]))
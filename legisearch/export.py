@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+'''static export of a namespace db for the search page in static_web
+
+Items are written as json shards, one per meeting body per year, so the
+page only downloads the bodies and years it is showing. Every shard also
+gets .gz and .br copies next to it, for servers that can send
+precompressed files (nginx gzip_static / brotli_static, etc).
+A `{namespace}.manifest.json` lists the shards and the body names.
+
+Each shard also gets a prebuilt MiniSearch index, `{year}.index.json`, so
+the page loads the index instead of building it on every visit. The
+manifest carries the MiniSearch options it has to be loaded with.
+
+The row shape is the one from dump.sql. With `fmt='compact'` shards are
+written column oriented instead, see `CompactShard`.
+'''
+
+from typing import Any, Dict, List, Mapping, Optional, TextIO, Tuple
+from datetime import datetime, timezone
+import os
+import calendar
+import gzip
+import json
+from sqlalchemy import select
+from legisearch import db
+from legisearch.searchindex import SearchIndex
+
+try:
+    import brotli
+except ImportError:  # optional, pip install legisearch[export]
+    brotli = None
+
+FORMATS = ('rows', 'compact')
+# minisearch field, row key, boost. the weights of settings.options in
+# static_web/legisearch.js
+SEARCHFIELDS = (
+    ('title', 'title', 0.7),
+    ('action_text', 'text', 0.6),
+)
+
+
+def index_options() -> Dict[str, Any]:
+    '''what the page passes to MiniSearch.loadJSON'''
+    return {
+        'fields': [field for field, _, _ in SEARCHFIELDS],
+        'searchOptions': {
+            'boost': {field: boost for field, _, boost in SEARCHFIELDS},
+        },
+    }
+
+
+def export_query():
+    '''the dump.sql join, ordered so each shard's rows come out together'''
+    return (
+        select(
+            db.items.c.id,
+            db.events.c.body_id,
+            db.bodies.c.name.label('body_name'),
+            db.events.c.agenda_url,
+            db.events.c.minutes_url,
+            db.events.c.insite_url,
+            db.events.c.meeting_time,
+            db.events.c.minutes_status,
+            db.items.c.agenda_number,
+            db.items.c.action_text,
+            db.items.c.title,
+            db.items.c.matter_id,
+            db.items.c.matter_status,
+            db.items.c.matter_attachments,
+            db.items.c.matter_type,
+        )
+        .select_from(db.items)
+        .join(db.events, db.events.c.id == db.items.c.event_id)
+        .outerjoin(db.bodies, db.bodies.c.id == db.events.c.body_id)
+        .order_by(db.events.c.body_id, db.events.c.meeting_time, db.items.c.id)
+    )
+
+
+def export_row(row) -> Dict[str, Any]:
+    meeting_time = row.meeting_time
+    return {
+        'id': row.id,
+        'b_id': row.body_id,
+        'b_name': row.body_name or str(row.body_id),
+        'agenda': row.agenda_url,
+        'minutes': row.minutes_url,
+        'insite': row.insite_url,
+        'meeting_time': meeting_time.isoformat(sep=' '),
+        'year': meeting_time.strftime('%Y'),
+        'month': meeting_time.strftime('%m'),
+        'minutes_status': row.minutes_status,
+        'a_num': row.agenda_number,
+        'text': row.action_text,
+        'title': row.title,
+        'matter': {
+            'id': row.matter_id,
+            'status': row.matter_status,
+            'attach': json.loads(row.matter_attachments or '{}'),
+            'type': row.matter_type,
+        },
+    }
+
+
+def compress(path: str) -> Dict[str, int]:
+    '''write .gz and .br copies of `path`, returns their sizes'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    copies = {'gz': gzip.compress(data, compresslevel=9)}
+    if brotli:
+        copies['br'] = brotli.compress(data, quality=11)
+    sizes = {}
+    for ext, compressed in copies.items():
+        with open(f'{path}.{ext}', 'wb') as f:
+            f.write(compressed)
+        sizes[ext] = len(compressed)
+    return sizes
+
+
+class StringTable:
+    '''hands out an index per distinct string, None stays None'''
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def __call__(self, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        if value not in self.ids:
+            self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return self.ids[value]
+
+
+def split_url(url: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    '''host and directory repeat across a namespace, file names do not'''
+    if url is None:
+        return None, None
+    cut = url.rfind('/') + 1
+    return url[:cut], url[cut:]
+
+
+def delta(values: List[int]) -> List[int]:
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+class CompactShard:
+    '''one shard as columns instead of an array of row objects
+
+    Rows of a shard share body and year, and rows of an event share its
+    time, status and urls, so those are stored once. Repeated strings
+    (matter types and statuses, agenda numbers, url prefixes, attachment
+    names) become indexes into `strings`. Item ids, event numbers and
+    meeting times (seconds since the epoch, local time) are delta encoded.
+    Urls are a prefix index plus the rest of the url, attachments are a
+    flat [name, prefix, rest, ...] list per item.
+
+    `compact.decode` in static_web/legisearch.js turns it back into rows.
+    '''
+
+    EVENTURLS = ('agenda', 'minutes', 'insite')
+
+    def __init__(self, body_id, year):
+        self.body_id = body_id
+        self.year = year
+        self.strings = StringTable()
+        self.event_key = None
+        self.events: Dict[str, list] = {'time': [], 'minutes_status': []}
+        for name in self.EVENTURLS:
+            self.events[name] = []
+            self.events[f'{name}_p'] = []
+        self.items: Dict[str, list] = {
+            name: [] for name in ('id', 'event', 'a_num', 'title', 'text',
+                                  'matter_id', 'matter_status', 'matter_type',
+                                  'attach')
+        }
+
+    def add_url(self, columns: Dict[str, list], name: str, url: Optional[str]):
+        prefix, rest = split_url(url)
+        columns[f'{name}_p'].append(self.strings(prefix))
+        columns[name].append(rest)
+
+    def add(self, row: Mapping[str, Any]):
+        key = (row['meeting_time'], row['minutes_status'],
+               *(row[name] for name in self.EVENTURLS))
+        if key != self.event_key:
+            self.event_key = key
+            meeting_time = datetime.fromisoformat(row['meeting_time'])
+            self.events['time'].append(
+                calendar.timegm(meeting_time.timetuple())
+            )
+            self.events['minutes_status'].append(row['minutes_status'])
+            for name in self.EVENTURLS:
+                self.add_url(self.events, name, row[name])
+        matter = row['matter']
+        attach: List[Any] = []
+        for name, url in matter['attach'].items():
+            prefix, rest = split_url(url)
+            attach.extend((self.strings(name), self.strings(prefix), rest))
+        items = self.items
+        items['id'].append(row['id'])
+        items['event'].append(len(self.events['time']) - 1)
+        items['a_num'].append(self.strings(row['a_num']))
+        items['title'].append(row['title'])
+        items['text'].append(row['text'])
+        items['matter_id'].append(matter['id'])
+        items['matter_status'].append(self.strings(matter['status']))
+        items['matter_type'].append(self.strings(matter['type']))
+        items['attach'].append(attach or None)
+
+    def to_json(self) -> Dict[str, Any]:
+        events = dict(self.events, time=delta(self.events['time']))
+        items = dict(
+            self.items,
+            id=delta(self.items['id']),
+            event=delta(self.items['event']),
+        )
+        return {
+            'b_id': self.body_id,
+            'year': str(self.year),
+            'count': len(self.items['id']),
+            'strings': self.strings.strings,
+            'events': events,
+            'items': items,
+        }
+
+
+class ShardWriter:
+    '''streams rows into one json array file per (body, year)
+
+    rows must arrive grouped by shard, only one file is open at a time.
+    compact shards are built in memory and written when the shard is done
+    '''
+
+    def __init__(self, outdir: str, namespace: str, fmt='rows'):
+        self.outdir = outdir
+        self.namespace = namespace
+        self.fmt = fmt
+        self.shards: List[Dict[str, Any]] = []
+        self.current: Optional[Tuple[Any, int]] = None
+        self.file: Optional[TextIO] = None
+        self.compact: Optional[CompactShard] = None
+        self.index: Optional[SearchIndex] = None
+
+    def write(self, row: Mapping[str, Any]):
+        key = (row['b_id'], int(row['year']))
+        if key != self.current:
+            self.close()
+            self.open(*key)
+        assert self.file is not None and self.index is not None
+        if self.compact:
+            self.compact.add(row)
+        else:
+            if self.shards[-1]['items']:
+                self.file.write(',\n')
+            json.dump(row, self.file, separators=(',', ':'))
+        self.index.add(row['id'], {
+            field: row[key] for field, key, _ in SEARCHFIELDS
+        })
+        self.shards[-1]['items'] += 1
+
+    def open(self, body_id, year):
+        path = f'{self.namespace}/{body_id}/{year}.json'
+        os.makedirs(os.path.join(self.outdir, os.path.dirname(path)),
+                    exist_ok=True)
+        self.current = (body_id, year)
+        self.file = file = open(os.path.join(self.outdir, path), 'w')
+        if self.fmt == 'compact':
+            self.compact = CompactShard(body_id, year)
+        else:
+            file.write('[')
+        self.index = SearchIndex(field for field, _, _ in SEARCHFIELDS)
+        self.shards.append(
+            {'body': body_id, 'year': year, 'path': path, 'items': 0}
+        )
+
+    def close(self):
+        if self.file is None or self.index is None:
+            return
+        if self.compact:
+            json.dump(self.compact.to_json(), self.file, separators=(',', ':'))
+            self.compact = None
+        else:
+            self.file.write(']')
+        self.file.close()
+        self.file = None
+        shard = self.shards[-1]
+        fullpath = os.path.join(self.outdir, shard['path'])
+        shard['bytes'] = os.path.getsize(fullpath)
+        shard['compressed'] = compress(fullpath)
+        shard['index'] = shard['path'][:-len('.json')] + '.index.json'
+        fullpath = os.path.join(self.outdir, shard['index'])
+        with open(fullpath, 'w') as f:
+            json.dump(self.index.to_json(), f, separators=(',', ':'))
+        self.index = None
+        shard['index_bytes'] = os.path.getsize(fullpath)
+        shard['index_compressed'] = compress(fullpath)
+
+
+async def export(namespace: str, outdir: str, fmt='rows'):
+    '''write shards and manifest for `namespace` under `outdir`'''
+    writer = ShardWriter(outdir, namespace, fmt)
+    async with db.new_connection(namespace) as conn:
+        result = await conn.execute(select(db.bodies))
+        bodies = {row.id: row.name for row in result}
+        async for row in await db.stream(conn, export_query()):
+            writer.write(export_row(row))
+    writer.close()
+    manifest = {
+        'namespace': namespace,
+        'generated': datetime.now(timezone.utc).isoformat(),
+        'format': fmt,
+        'bodies': bodies,
+        'index': index_options(),
+        'shards': writer.shards,
+    }
+    path = os.path.join(outdir, f'{namespace}.manifest.json')
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    compress(path)
+    return manifest
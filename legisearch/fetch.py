@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 
-from typing import Mapping, Any
+from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
 import json
-from datetime import datetime, time
-from dateutil.parser import parse
-from sqlalchemy import func, select, exc
+import asyncio
+from datetime import datetime, date, timedelta, timezone
+from sqlalchemy import func, select, exc, or_
 from legisearch.legistar import fetch_event_items, \
-    FINALSTATUS, fetch_bodies, add_item_data, add_matter_data
-from legisearch import db
+    fetch_changed_event_items, FINALSTATUS, CONCURRENCY, fetch_bodies_async
+from legisearch import db, metrics, archive, dates
+from legisearch.models import Event, EventItem, Body, Meeting
+
+EVENTMARK = 'EventLastModifiedUtc'
+ITEMMARK = 'EventItemLastModifiedUtc'
+LASTSYNC = 'LastSyncUtc'  # when sync last finished, not a legistar field
+SYNCDAYS = 120  # minutes are usually final within a few months
+BATCHSIZE = 50  # events per bulk insert and commit
 
 
 async def setup_db(namespace: str, conn):
@@ -16,50 +27,313 @@ async def setup_db(namespace: str, conn):
 
 
 async def insert_bodies(namespace: str, conn):
-    bodies = fetch_bodies(namespace)
+    bodies = await fetch_bodies_async(namespace)
+    with archive.Archive(namespace) as archived:
+        archived.add_bodies(bodies)
+    await body_rows(conn, bodies)
+
+
+async def body_rows(conn, bodies: List[Body]):
     await conn.execute(
         db.bodies.insert(),
-        [{'id': int(b['BodyId']), 'name': b['BodyName'].strip()} for b in bodies]
+        [{'id': int(b.BodyId), 'name': b.BodyName.strip()} for b in bodies]
     )
 
 
 async def fetch_more_events(
     namespace: str,
     limit=100,
-    refetch_nonfinal=False,
+    concurrency=CONCURRENCY,
+    fetch_matter_text=False,
+    fetch_item_extra=False,
+    cache=True,
+    batch_size=BATCHSIZE,
 ):
     '''check the max event id from the db, and fetch `limit` more events'''
     minid = None
-    async with db.new_connection(namespace) as conn:
-        minid = await fetch_minid(conn, refetch_nonfinal, namespace)
+    async with db.new_connection(namespace, begin=False) as conn:
+        minid = await fetch_minid(conn, namespace)
+        # bring older dbs up to date, adds sync_state and the search index
+        await db.create_tables(namespace, conn)
+        marks = await fetch_marks(conn)
         if minid is None:
             minid = 0
+        # only sync moves the marks on. Fetching newer events says nothing
+        # about edits to the ones already stored, so a fetch only seeds
+        # the marks of a db that had nothing in it
+        seed = not minid and not marks
         print(f'fetching up to {limit} {namespace} events, minid {minid}\n')
         event_item_iter = fetch_event_items(
-            namespace, min_id=minid, limit=limit
+            namespace, min_id=minid, limit=limit, concurrency=concurrency,
+            fetch_matter_text=fetch_matter_text,
+            fetch_item_extra=fetch_item_extra,
+            cache=cache,
         )
         inserted = 0
-        async for event, items in event_item_iter:
-            if not inserted % 15:
-                print(f'\r{event["EventId"]} has {len(items)} items', end='')
-            filtered = format_event(namespace, event, items)
-            if filtered:
-                await insert_event(conn, filtered)
-                inserted += 1
-        print(f'\rinserted {inserted} events')
+        page: List[Tuple[Event, List[EventItem]]] = []
+        with archive.Archive(namespace) as archived:
+            async with EventWriter(conn, batch_size) as writer:
+                async for event, items in event_item_iter:
+                    if not len(page) % 15:
+                        print(f'\r{namespace} {event.EventId} has '
+                              f'{len(items)} items', end='')
+                    archived.add(event, items)
+                    if seed:
+                        update_marks(marks, event, items)
+                    page.append((event, items))
+                    if len(page) >= batch_size:
+                        inserted += await add_page(writer, namespace, page)
+                inserted += await add_page(writer, namespace, page)
+        if seed:
+            await store_marks(conn, marks)
+        await db.analyze(conn)
+        print(f'\rinserted {inserted} {namespace} events')
+
+
+async def fetch_namespaces(namespaces, **kwargs):
+    '''run `fetch_more_events` for every namespace at once, in one loop
+
+    they share the per-host rate limit, so the whole run takes about as long
+    as the biggest namespace. One failing namespace does not stop the rest.
+    '''
+    results = await asyncio.gather(
+        *(fetch_more_events(ns, **kwargs) for ns in namespaces),
+        return_exceptions=True,
+    )
+    failed = {
+        ns: result for ns, result in zip(namespaces, results)
+        if isinstance(result, Exception)
+    }
+    for ns, error in failed.items():
+        print(f'failed to fetch {ns}: {error!r}', file=sys.stderr)
+    if failed:
+        raise RuntimeError(f'fetch failed for {", ".join(failed)}')
+
+
+async def sync_events(
+    namespace: str,
+    concurrency=CONCURRENCY,
+    days=SYNCDAYS,
+    batch_size=BATCHSIZE,
+):
+    '''fetch and upsert only the events and items changed since the last sync
+
+    Events are found by EventLastModifiedUtc. Item edits do not always touch
+    their event, so events from the last `days` without final minutes are
+    also checked for items past the EventItemLastModifiedUtc mark.
+    '''
+    async with db.new_connection(namespace, begin=False) as conn:
+        if await fetch_minid(conn, namespace) is None:
+            print(f'no {namespace} events yet, use fetch first')
+            return
+        await db.create_tables(namespace, conn)
+        marks = await fetch_marks(conn)
+        if not marks.get(EVENTMARK):
+            print('no previous sync, every event will be refetched')
+        result = await conn.execute(
+            select(db.events.c.id)
+            .where(or_(
+                db.events.c.minutes_status != FINALSTATUS,
+                db.events.c.minutes_status.is_(None),
+            ))
+            .where(db.events.c.meeting_time >= date.today() - timedelta(days))
+        )
+        nonfinal = [row[0] for row in result]
+        print(f'syncing {namespace} events modified since '
+              f'{marks.get(EVENTMARK)}, checking {len(nonfinal)} '
+              'events without final minutes\n')
+        event_item_iter = fetch_changed_event_items(
+            namespace,
+            event_since=marks.get(EVENTMARK),
+            item_since=marks.get(ITEMMARK),
+            event_ids=nonfinal,
+            concurrency=concurrency,
+        )
+        synced = 0
+        page: List[Tuple[Event, List[EventItem]]] = []
+        with archive.Archive(namespace) as archived:
+            async with EventWriter(conn, batch_size, replace=True) as writer:
+                async for event, items in event_item_iter:
+                    print(f'\r{event.EventId} has {len(items)} items',
+                          end='')
+                    archived.add(event, items)
+                    update_marks(marks, event, items)
+                    page.append((event, items))
+                    if len(page) >= batch_size:
+                        synced += await add_page(writer, namespace, page)
+                synced += await add_page(writer, namespace, page)
+        marks[LASTSYNC] = datetime.now(timezone.utc).isoformat(
+            timespec='seconds'
+        )
+        await store_marks(conn, marks)
+        await db.analyze(conn)
+        print(f'\rsynced {synced} events')
+
+
+async def rebuild(
+    namespace: str,
+    jobs: Optional[int] = None,
+    batch_size=BATCHSIZE,
+    force=False,
+):
+    '''replay the namespace's archive into a new db, no network needed
 
+    Only the newest copy of each event is used. format_event runs in `jobs`
+    worker processes, a batch at a time. The db is built next to the old
+    one and swapped in when complete.
 
-async def fetch_minid(conn, refetch_nonfinal, namespace='', retry=True):
+    The archive only has what was fetched since it was added, so unless
+    `force`, an old db with events the archive lacks is left alone.
+    '''
+    if not os.path.exists(archive.archive_file(namespace)):
+        print(f'no archive for {namespace}, fetch first')
+        return
+    jobs = jobs or os.cpu_count() or 1
+    lines, bodies = archive.latest(namespace)
+    missing = await unarchived(namespace, lines)
+    if missing and not force:
+        print(f'{missing} {namespace} events in {db.db_file(namespace)} are '
+              'not in the archive and would be lost, use --force to '
+              'rebuild anyway', file=sys.stderr)
+        return
+    if bodies is None:
+        bodies = await stored_bodies(namespace)
+    print(f'rebuilding {len(lines)} {namespace} events with {jobs} jobs\n')
+    building = f'{namespace}.rebuild'
+    marks: Dict[str, str] = {}
+    rebuilt = 0
+    async with db.new_connection(building, begin=False) as conn:
+        await db.recreate_tables(building, conn)
+        await body_rows(conn, bodies)
+        with ProcessPoolExecutor(jobs) as pool:
+            loop = asyncio.get_running_loop()
+            pending: deque = deque()
+            async with EventWriter(conn, batch_size) as writer:
+                for batch in archive_batches(namespace, lines, batch_size):
+                    pending.append(loop.run_in_executor(
+                        pool, format_lines, namespace, batch
+                    ))
+                    # keep every worker busy, without reading ahead too far
+                    if len(pending) <= jobs * 2:
+                        continue
+                    rebuilt += await write_batch(
+                        writer, marks, await pending.popleft()
+                    )
+                    print(f'\r{rebuilt} events', end='')
+                while pending:
+                    rebuilt += await write_batch(
+                        writer, marks, await pending.popleft()
+                    )
+        await store_marks(conn, marks)
+        await db.analyze(conn)
+    await db.dispose_engines()
+    if not await checkpoint(namespace):
+        print(f'\n{db.db_file(namespace)} is in use, left the rebuilt db '
+              f'in {db.db_file(building)}', file=sys.stderr)
+        return
+    os.replace(db.db_file(building), db.db_file(namespace))
+    print(f'\rrebuilt {rebuilt} {namespace} events')
+
+
+async def unarchived(namespace: str, lines: Dict[int, int]) -> int:
+    '''how many events in the current db have no copy in the archive'''
+    if not os.path.exists(db.db_file(namespace)):
+        return 0
     try:
-        if refetch_nonfinal:
-            result = await conn.exectue(
-                select(db.events)
-                .where(db.events.c.minutestatus != FINALSTATUS)
-            )
-        else:
-            result = await conn.execute(
-                select(func.max(db.events.c.id))
+        async with db.new_connection(namespace) as conn:
+            result = await conn.execute(select(db.events.c.id))
+            return sum(1 for row in result if row.id not in lines)
+    except exc.OperationalError:
+        return 0
+    finally:
+        await db.dispose_engines()
+
+
+async def checkpoint(namespace: str) -> bool:
+    '''move the wal of the current db into the db file, before replacing it
+
+    False when another connection is still reading the wal, its file is
+    not ours to delete
+    '''
+    if not os.path.exists(db.db_file(namespace)):
+        return True
+    try:
+        async with db.new_connection(namespace, begin=False) as conn:
+            result = await conn.exec_driver_sql(
+                'PRAGMA wal_checkpoint(TRUNCATE)'
             )
+            busy, _, _ = result.one()
+    finally:
+        await db.dispose_engines()
+    return not busy
+
+
+async def stored_bodies(namespace: str) -> List[Body]:
+    '''bodies from the current db, for archives from before bodies were kept'''
+    try:
+        async with db.new_connection(namespace) as conn:
+            result = await conn.execute(select(db.bodies))
+            return [Body(row.id, row.name) for row in result]
+    except exc.OperationalError:
+        return []
+
+
+def archive_batches(namespace: str, lines: Dict[int, int], batch_size: int):
+    '''raw archive lines of the events to replay, `batch_size` at a time'''
+    wanted = set(lines.values())
+    batch = []
+    for lineno, line in archive.read(namespace):
+        if lineno in wanted:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def format_lines(
+    namespace: str,
+    lines: List[str],
+) -> Tuple[List[Meeting], Dict[str, str]]:
+    '''format_event for archive lines, runs in a worker process'''
+    marks: Dict[str, str] = {}
+    records = [archive.records(line) for line in lines]
+    for event, items in records:
+        update_marks(marks, event, items)
+    return [m for m in format_events(namespace, records) if m], marks
+
+
+async def add_page(
+    writer,
+    namespace: str,
+    page: List[Tuple[Event, List[EventItem]]],
+) -> int:
+    '''format a page of events together and queue them, emptying `page`
+
+    returns how many of them are meetings worth keeping
+    '''
+    meetings = [m for m in format_events(namespace, page) if m]
+    for meeting in meetings:
+        await writer.add(meeting)
+    page.clear()
+    return len(meetings)
+
+
+async def write_batch(writer, marks: Dict[str, str], formatted) -> int:
+    events, batch_marks = formatted
+    for key, value in batch_marks.items():
+        marks[key] = max(marks.get(key, value), value)
+    for event in events:
+        await writer.add(event)
+    return len(events)
+
+
+async def fetch_minid(conn, namespace='', retry=True):
+    try:
+        result = await conn.execute(
+            select(func.max(db.events.c.id))
+        )
         minid, = result.fetchone()
         return minid
     except exc.OperationalError:
@@ -67,124 +341,205 @@ async def fetch_minid(conn, refetch_nonfinal, namespace='', retry=True):
             # probably our first run
             print('mmm, db seems missing. attempting to create')
             await setup_db(namespace, conn)
-            return await fetch_minid(conn, refetch_nonfinal, False)
+            return await fetch_minid(conn, namespace, False)
         else:
             raise
 
 
+async def fetch_marks(conn) -> Dict[str, str]:
+    result = await conn.execute(select(db.sync_state))
+    return {row.key: row.value for row in result}
+
+
+async def store_marks(conn, marks: Dict[str, str]):
+    if marks:
+        await conn.execute(
+            db.sync_state.insert(),
+            [{'key': k, 'value': v} for k, v in marks.items()]
+        )
+
+
+def update_marks(
+    marks: Dict[str, str],
+    event: Event,
+    items: List[EventItem],
+):
+    '''raise the high-water marks to cover `event` and its `items`
+
+    legistar timestamps are all the same iso format, so plain string
+    comparison orders them correctly
+    '''
+    stamps = {
+        EVENTMARK: [event.EventLastModifiedUtc],
+        ITEMMARK: [item.EventItemLastModifiedUtc for item in items],
+    }
+    for key, values in stamps.items():
+        newest = max(filter(None, (marks.get(key), *values)), default=None)
+        if newest is not None:
+            marks[key] = newest
+
+
+@metrics.FORMAT_SECONDS.timed
 def format_event(
     namespace,
-    event,
-    items,
-    fetch_matter_text=False,
-    fetch_item_extra=False,
-) -> Mapping[str, Any]:
-    event_items = {}
+    event: Event,
+    items: List[EventItem],
+    when: Optional[datetime] = None,
+) -> Meeting:
+    '''merge `items` into agenda entries, and find when the meeting is
+
+    `when` is the meeting time if it was already parsed, see format_events
+    '''
+    event_items: Dict[str, EventItem] = {}
     # some event items are just text, and are motions or discussion
     # related to the previous item. So we keep track of the item and
     # append to it's description
     agenda_number = ''
     for item in items:
-        if not item.get('EventItemId'):
+        if not item.EventItemId:
             print('item has no id')
             print(item)
             continue
 
-        if item['EventItemAgendaNumber']:
-            agenda_number = item['EventItemAgendaNumber'].strip()
-        item['EventItemAgendaNumber'] = agenda_number
-
-        if fetch_item_extra:
-            add_item_data(namespace, item)
-        if fetch_matter_text:
-            add_matter_data(namespace, item)
-        item['attachments'] = json.dumps(
-            {m['MatterAttachmentName']: m['MatterAttachmentHyperlink']
-             for m in item.pop('EventItemMatterAttachments')}
-        )
-        possibleTexts = filter(
-            None,
-            (
-                item['EventItemMatterType'],
-                item['EventItemAgendaNumber'],
-                item['EventItemTitle'],
-                item['EventItemActionText'],
-            )
-        )
-        if possibleTexts:
-            item['lower_text'] = '\n'.join(possibleTexts).lower()
-        else:
-            item['lower_text'] = None
+        if item.EventItemAgendaNumber:
+            agenda_number = item.EventItemAgendaNumber.strip()
+        if item.EventItemAgendaNumber != agenda_number:
+            item = item._replace(EventItemAgendaNumber=agenda_number)
 
         if agenda_number and agenda_number in event_items:
-            append_item_data(event_items[agenda_number], item)
+            event_items[agenda_number] = merge_items(
+                event_items[agenda_number], item
+            )
         else:
             event_items[agenda_number] = item
 
-    # TODO: timezone stuff
-    try:
-        date = datetime.fromisoformat(event['EventDate'])
-        if event['EventTime']:
-            try:
-                hour = parse(event['EventTime']).time()
-            except Exception:
-                print(f'failed to parse time for {event}, using noon')
-                hour = time(12)
-        else:
-            hour = time(12)
-        dt = datetime.combine(date.date(), hour)
-        event['datetime'] = dt
-    except Exception as e:
-        print(f'failed to parse date {event} {e}')
-    event['items'] = list(event_items.values())
-    return event
+    if when is None:
+        when = dates.meeting_time(
+            event.EventDate, event.EventTime, dates.namespace_zone(namespace)
+        )
+    if when is None:
+        print(f'failed to parse date for {event}')
+    metrics.RECORDS.inc(stage='format_event')
+    return Meeting(event, when, list(event_items.values()))
+
+
+def format_events(
+    namespace,
+    pairs: List[Tuple[Event, List[EventItem]]],
+) -> List[Meeting]:
+    '''format_event for a batch of (event, items), dates parsed together'''
+    times = dates.meeting_times(
+        (event for event, _ in pairs), dates.namespace_zone(namespace)
+    )
+    return [format_event(namespace, event, items, when)
+            for (event, items), when in zip(pairs, times)]
 
 
-def append_item_data(item_base, new_data):
+def merge_items(item_base: EventItem, new_data: EventItem) -> EventItem:
+    merged: Dict[str, Any] = {}
     for to_merge in ('EventItemTitle', 'EventItemActionText'):
-        if new_data.get(to_merge):
-            if item_base.get(to_merge):
-                item_base[to_merge] = f'{item_base[to_merge].strip()}\n\n{new_data[to_merge].strip()}'
+        new = getattr(new_data, to_merge)
+        if new:
+            base = getattr(item_base, to_merge)
+            if base:
+                merged[to_merge] = f'{base.strip()}\n\n{new.strip()}'
             else:
-                item_base[to_merge] = new_data[to_merge].strip()
+                merged[to_merge] = new.strip()
+    return item_base._replace(**merged) if merged else item_base
 
 
-async def insert_event(conn, event):
-    # insert event
-    # json.dump(event, sys.stdout, indent=2, default=str)
-    await conn.execute(
-        db.events.insert(),
-        [{
-            'id': event['EventId'],
-            'body_id': event['EventBodyId'],
-            'meeting_time': event['datetime'],
-            'agenda_url': event['EventAgendaFile'] or '',
-            'minutes_url': event.get('EventMinutesFile'),
-            'minutes_status': event.get('EventMinutesStatusId'),
-            'insite_url': event.get('EventInSiteURL')
-        }]
-    )
-    if event.get('items'):
-        await conn.execute(
-            db.items.insert(),
-            [{
-                'id': item['EventItemId'],
-                'event_id': event['EventId'],
-                'agenda_number': item['EventItemAgendaNumber'],
-                'action_text': item['EventItemActionText'],
-                'title': item['EventItemTitle'],
-                # 'full_text_lower': item['lower_text'],
-                'matter_id': item['EventItemMatterId'],
-                'matter_attachments': item['attachments'],
-                'matter_status': item['EventItemMatterStatus'],
-                'matter_type': item['EventItemMatterType'],
-            } for item in event['items']]
-        )
+class EventWriter:
+    '''buffers formatted events and writes them `batch_size` at a time
+
+    Each flush is one executemany per table and a commit, so readers see a
+    long fetch as it goes, and an interrupted one keeps every full batch.
+    With `replace` the old items of each event are deleted first, for
+    events whose item list may have shrunk.
+    '''
+
+    def __init__(self, conn, batch_size=BATCHSIZE, replace=False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.replace = replace
+        self.events: List[Dict[str, Any]] = []
+        self.items: List[Dict[str, Any]] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.flush()
+
+    async def add(self, meeting: Meeting):
+        self.events.append(event_row(meeting))
+        self.items.extend(item_rows(meeting))
+        if len(self.events) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.events:
+            return
+        with metrics.INSERT_SECONDS.time():
+            if self.replace:
+                await self.conn.execute(
+                    db.items.delete().where(db.items.c.event_id.in_(
+                        [e['id'] for e in self.events]
+                    ))
+                )
+            await self.conn.execute(db.events.insert(), self.events)
+            if self.items:
+                await self.conn.execute(db.items.insert(), self.items)
+            await self.conn.commit()
+        metrics.RECORDS.inc(len(self.events), stage='insert/events')
+        metrics.RECORDS.inc(len(self.items), stage='insert/items')
+        self.events = []
+        self.items = []
+
+
+def event_row(meeting: Meeting) -> Dict[str, Any]:
+    event = meeting.event
+    return {
+        'id': event.EventId,
+        'body_id': event.EventBodyId,
+        'meeting_time': meeting.meeting_time,
+        'agenda_url': event.EventAgendaFile or '',
+        'minutes_url': event.EventMinutesFile,
+        'minutes_status': event.EventMinutesStatusId,
+        'insite_url': event.EventInSiteURL,
+        'location': event.EventLocation,
+        'body_name': event.EventBodyName,
+    }
+
+
+def item_rows(meeting: Meeting) -> List[Dict[str, Any]]:
+    '''db rows for the items. `extra` is left to the archive'''
+    event_id = meeting.event.EventId
+    return [{
+        'id': item.EventItemId,
+        'event_id': event_id,
+        'agenda_number': item.EventItemAgendaNumber,
+        'action_text': item.EventItemActionText,
+        'title': item.EventItemTitle,
+        'matter_id': item.EventItemMatterId,
+        'matter_attachments': json.dumps({
+            a.MatterAttachmentName: a.MatterAttachmentHyperlink
+            for a in item.EventItemMatterAttachments
+        }),
+        'matter_status': item.EventItemMatterStatus,
+        'matter_type': item.EventItemMatterType,
+    } for item in meeting.items]
+
+
+async def insert_event(conn, meeting: Meeting):
+    '''write a single event, use EventWriter for bulk inserts'''
+    await conn.execute(db.events.insert(), [event_row(meeting)])
+    rows = item_rows(meeting)
+    if rows:
+        await conn.execute(db.items.insert(), rows)
 
 
 if __name__ == '__main__':
-    import sys
-    import asyncio
     from pprint import pprint
     namespace = sys.argv[1]
     minid = int(sys.argv[2])
@@ -1,5 +1,5 @@
-from typing import Mapping, Tuple, Dict, Any, AsyncGenerator, Optional
-from urllib import request
+from typing import Any, Tuple, Dict, AsyncGenerator, Optional, Deque, List
+from collections import deque
 from datetime import datetime, time
 from dateutil.parser import parse
 import sys
@@ -8,6 +8,10 @@ import math
 import logging
 import asyncio
 import httpx
+from legisearch.cache import response_cache, AsyncCacheTransport
+from legisearch.ratelimit import RateLimitTransport
+from legisearch import metrics
+from legisearch.models import Event, EventItem, Body
 
 
 # Legistar web api is documented here
@@ -27,14 +31,18 @@ BASEURL = 'https://webapi.legistar.com/v1/'
 EVENTFIELDS = (
     'EventId',
     'EventBodyId',
+    'EventBodyName',
     'EventDate',
     'EventTime',
+    'EventLocation',
     'EventAgendaFile',
     'EventMinutesFile',
     'EventMinutesStatusId',
-    'EventInSiteURL')
+    'EventInSiteURL',
+    'EventLastModifiedUtc')
 ITEMFIELDS = (
     'EventItemId',
+    'EventItemLastModifiedUtc',
     'EventItemAgendaNumber',
     'EventItemActionText',
     'EventItemTitle',
@@ -43,9 +51,38 @@ ITEMFIELDS = (
     'EventItemMatterAttachments/MatterAttachmentHyperlink',
     'EventItemMatterStatus',
     'EventItemMatterType')
+# legistar namespaces in Santa Clara County, by city
+KNOWN_NAMESPACES = {
+    'San Jose': 'sanjose',
+    'Sunnyvale': 'sunnyvaleca',
+    'Santa Clara': 'santaclara',
+    'Mountain View': 'mountainview',
+    'Cupertino': 'cupertino',
+    'BART': 'bart',
+}
 TEMPLATE = 'councildoc.html.template'
 FINALSTATUS = 10  # for re-downloading non-final events
 TM = 10000  # default timeout ten seconds
+PAGESIZE = 1000  # legistar will not return more than 1000 records per request
+CONCURRENCY = 8  # max eventitems requests in flight at once
+ITEMSUBCATS = ('Votes', 'RollCalls')
+MATTERSUBCATS = (
+    'CodeSections', 'Histories', 'Versions', 'Sponsors', 'Attachments'
+)
+
+
+def new_client(cache=True) -> httpx.AsyncClient:
+    '''async client, with responses cached on disk unless `cache` is False
+
+    requests that miss the cache are paced by the shared per-host limiter
+    '''
+    transport: httpx.AsyncBaseTransport = RateLimitTransport(
+        httpx.AsyncHTTPTransport(retries=2)
+    )
+    rcache = response_cache() if cache else None
+    if rcache:
+        transport = AsyncCacheTransport(transport, rcache)
+    return httpx.AsyncClient(transport=transport)
 
 
 def events_url(
@@ -54,14 +91,19 @@ def events_url(
     limit: int = 1000,
     fields=EVENTFIELDS,
 ) -> Tuple[str, Dict[str, str]]:
-    '''An assumption here is that event_id always increases'''
-    url = f'{BASEURL}{namespace}/events?'
+    '''An assumption here is that event_id always increases
+
+    Pages are windowed on `EventId gt min_id` rather than `$skip`, so
+    events added while we are crawling do not shift the window under us
+    '''
+    url = f'{BASEURL}{namespace}/events'
     params = {
         '$orderby': 'EventId',
         '$select': ','.join(fields),
+        '$top': str(min(limit, PAGESIZE)),
     }
-    if limit and limit < 1000:
-        params['$top'] = str(limit)
+    if min_id:
+        params['$filter'] = f'EventId gt {min_id}'
 
     return url, params
 
@@ -91,18 +133,98 @@ async def fetch_event_items(
     limit=math.inf,
     fields=EVENTFIELDS,
     filter_='EventAgendaFile ne null',
-) -> AsyncGenerator[Tuple[Mapping[str, Any], Mapping[str, Any]], None]:
-    transport = httpx.AsyncHTTPTransport(retries=2)
-    async with httpx.AsyncClient(transport=transport) as client:
+    concurrency=CONCURRENCY,
+    fetch_matter_text=False,
+    fetch_item_extra=False,
+    cache=True,
+) -> AsyncGenerator[Tuple[Event, List[EventItem]], None]:
+    async with new_client(cache) as client:
         event_gen = fetch_events(
             client, namespace, min_id, limit, fields, filter_
         )
         async for event, items in fetch_items(
-            client, namespace, event_gen
+            client, namespace, event_gen, concurrency,
+            fetch_matter_text, fetch_item_extra,
         ):
             yield event, items
 
 
+async def fetch_changed_event_items(
+    namespace: str,
+    event_since: Optional[str] = None,
+    item_since: Optional[str] = None,
+    event_ids=(),
+    concurrency=CONCURRENCY,
+    cache=False,
+) -> AsyncGenerator[Tuple[Event, List[EventItem]], None]:
+    '''events modified after `event_since`, with all their items
+
+    Editing an item does not always touch the event, so any of `event_ids`
+    with items modified after `item_since` are refetched as well. Without
+    `event_since` every event is fetched. Responses are not cached by
+    default, stale data would defeat the point.
+    '''
+    async with new_client(cache) as client:
+        async def changed_events():
+            seen = set()
+            filter_ = 'EventAgendaFile ne null'
+            if event_since:
+                filter_ += (
+                    f" and EventLastModifiedUtc gt datetime'{event_since}'"
+                )
+            events = fetch_events(client, namespace, filter_=filter_)
+            async for event in events:
+                seen.add(event.EventId)
+                yield event
+            if not item_since:
+                return
+            changed = await items_changed(
+                client, namespace,
+                [eid for eid in event_ids if eid not in seen],
+                item_since, concurrency,
+            )
+            # batch the ids into a few `or` filters, not one request each
+            for i in range(0, len(changed), 50):
+                id_filter = ' or '.join(
+                    f'EventId eq {eid}' for eid in changed[i:i + 50]
+                )
+                async for event in fetch_events(
+                    client, namespace, filter_=f'({id_filter})'
+                ):
+                    yield event
+
+        async for event, items in fetch_items(
+            client, namespace, changed_events(), concurrency
+        ):
+            yield event, items
+
+
+async def items_changed(
+    client: httpx.AsyncClient,
+    namespace: str,
+    event_ids,
+    since: str,
+    concurrency=CONCURRENCY,
+):
+    '''which of `event_ids` have any item modified after `since`'''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(event_id):
+        url, _ = items_url(namespace, event_id)
+        params = {
+            '$filter': f"EventItemLastModifiedUtc gt datetime'{since}'",
+            '$select': 'EventItemId',
+            '$top': '1',
+        }
+        async with semaphore:
+            response = await client.get(url, params=params, timeout=TM)
+        response.raise_for_status()
+        return event_id if decode(response) else None
+
+    results = await gather(*(check(eid) for eid in event_ids))
+    return [eid for eid in results if eid]
+
+
 async def fetch_events(
     client: httpx.AsyncClient,
     namespace: str,
@@ -110,81 +232,224 @@ async def fetch_events(
     limit=math.inf,
     fields=EVENTFIELDS,
     filter_='EventAgendaFile ne null',
-) -> AsyncGenerator[Mapping[str, Any], None]:
-    '''fetches events from the legistart api
+) -> AsyncGenerator[Event, None]:
+    '''fetches events from the legistar api
 
-    will start at `min_id` and continue until `limit`
+    will start at `min_id` and page through until `limit` events have been
+    yielded or the api runs out. Events are yielded as each page arrives,
+    only one page is held in memory at a time
     '''
-    if min_id:
-        filter_ += f' and EventId gt {min_id}'
-    url, params = events_url(namespace, min_id, limit, fields)
-    if filter_:
-        params['$filter'] = filter_
-    omid = min_id
-    response = await client.get(url, params=params, timeout=TM)
-    events = response.json()
-    for event in events:
-        limit -= 1
-        yield event
-
-    if limit and min_id != omid:
-        async for event in fetch_events(min_id, limit):
+    while limit > 0:
+        url, params = events_url(namespace, min_id, limit, fields)
+        if filter_:
+            params['$filter'] = ' and '.join(
+                f for f in (filter_, params.get('$filter')) if f
+            )
+        response = await client.get(url, params=params, timeout=TM)
+        response.raise_for_status()
+        events = decode(response, Event)
+        for event in events:
+            min_id = event.EventId
+            limit -= 1
             yield event
+        if len(events) < int(params['$top']):
+            # short page, nothing left to fetch
+            break
 
 
 async def fetch_items(
     client: httpx.AsyncClient,
     namespace: str,
-    event_gen
+    event_gen,
+    concurrency=CONCURRENCY,
+    fetch_matter_text=False,
+    fetch_item_extra=False,
 ):
-    futures = []
-    events = []
-    noitemevents = []
-    async for event in event_gen:
-        if not event['EventAgendaFile']:
-            noitemevents.append(event)
-            continue
-        events.append(event)
-        # fetch event items
-        iurl, iparams = items_url(namespace, event['EventId'])
-        futures.append(client.get(iurl, params=iparams, timeout=TM))
+    '''fetch the items for each event coming out of `event_gen`
+
+    Up to `concurrency` item requests run at once, and events keep being
+    pulled from `event_gen` while they do. Pairs are yielded in event order
+    as soon as the oldest outstanding request finishes. Keeping the order
+    means an interrupted fetch never leaves gaps below the max event id.
 
-    for event, item_resp in zip(events, await asyncio.gather(*futures)):
-        item = item_resp.json()
-        yield (event, item)
-    for event in noitemevents:
-        yield (event, [])
+    `fetch_matter_text` and `fetch_item_extra` enrich each item before it is
+    yielded, see `enrich_items`
+    '''
+    matters: Dict[int, asyncio.Future] = {}
+
+    async def get_items(event):
+        if not event.EventAgendaFile:
+            return event, []
+        iurl, iparams = items_url(namespace, event.EventId)
+        response = await client.get(iurl, params=iparams, timeout=TM)
+        response.raise_for_status()
+        items = decode(response, EventItem)
+        await enrich_items(
+            client, namespace, items, matters,
+            fetch_matter_text, fetch_item_extra,
+        )
+        return event, items
+
+    pending: Deque[asyncio.Task] = deque()
+    try:
+        async for event in event_gen:
+            pending.append(asyncio.create_task(get_items(event)))
+            while pending and (
+                pending[0].done() or len(pending) >= concurrency
+            ):
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # matter fetches are shared between events, so they are not owned
+        # by any one task and have to be stopped too, before the client
+        # closes under them
+        outstanding = [*pending, *matters.values()]
+        for task in outstanding:
+            task.cancel()
+        # wait for them to finish cancelling, this also retrieves any
+        # exception so none is logged as never retrieved
+        await asyncio.gather(*outstanding, return_exceptions=True)
+
+
+async def gather(*aws):
+    '''asyncio.gather, but the rest are cancelled as soon as one fails
+
+    plain gather leaves them running, against a client about to be closed
+    '''
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
-def add_item_data(namespace, item):
+def decode(response: httpx.Response, model=None):
+    '''the json body, a list of `model` records if given
+
+    parsed straight from the bytes, counting bytes, records and decode time
+    '''
+    name = metrics.endpoint(response.url.path)
+    metrics.RESPONSE_BYTES.inc(len(response.content), endpoint=name)
+    with metrics.DECODE_SECONDS.time(endpoint=name):
+        data = json.loads(response.content)
+        if model is not None:
+            data = [model.from_api(d) for d in data]
+    metrics.RECORDS.inc(
+        len(data) if isinstance(data, list) else 1, stage=name
+    )
+    return data
+
+
+async def get_json(client: httpx.AsyncClient, url: str):
+    response = await client.get(url, timeout=TM)
+    response.raise_for_status()
+    return decode(response)
+
+
+async def enrich_items(
+    client: httpx.AsyncClient,
+    namespace: str,
+    items: List[EventItem],
+    matters: Dict[int, asyncio.Future],
+    fetch_matter_text=False,
+    fetch_item_extra=False,
+):
+    '''add votes and matter details to `items`, all requests run concurrently
+
+    they go in each item's `extra`, items getting any are replaced in the
+    list. `matters` is shared for the whole run so each matter is only
+    fetched once no matter how many agendas it shows up on
+    '''
+    jobs = []
+    for i, item in enumerate(items):
+        if not item.EventItemId:
+            continue
+        extra: Dict[str, Any] = dict(item.extra or ())
+        if fetch_item_extra or fetch_matter_text and item.EventItemMatterId:
+            items[i] = item._replace(extra=extra)
+        if fetch_item_extra:
+            jobs.append(add_item_data(client, namespace, item, extra))
+        if fetch_matter_text:
+            jobs.append(
+                add_matter_data(client, namespace, item, extra, matters)
+            )
+    if jobs:
+        await gather(*jobs)
+
+
+async def add_item_data(
+    client: httpx.AsyncClient,
+    namespace: str,
+    item: EventItem,
+    extra: Dict[str, Any],
+):
     # sqlite supports json, but the python stdlib doesn't interface easily
     # so I just store as text, and use JSON.parse on the frontend
-    for subcat in ['Votes', 'RollCalls']:
-        url = f'{BASEURL}{namespace}/EventItems/{item["EventItemId"]}/{subcat}'
-        data = json.load(request.urlopen(url))
-        item[subcat] = data
-
-
-def add_matter_data(namespace: str, item):
-    mid = item['EventItemMatterId']
-    subcats = [
-        'CodeSections', 'Histories', 'Versions', 'Sponsors', 'Attachments'
-    ]
-    if mid:
-        url = BASEURL + namespace + f'/Matters/{mid}'
-        data = json.load(request.urlopen(url))
-        item['Matter'] = data
-        for subcat in subcats:
-            url = f'{BASEURL}{namespace}/Matters/{mid}/{subcat}'
-            data = json.load(request.urlopen(url))
-            item[subcat] = data
-
-
-def fetch_bodies(namespace: str):
-    '''fetch and store meeting body data. city council is 138, etc'''
-    url = BASEURL + namespace + '/bodies?$select=BodyId,BodyName'
-    bodies = json.load(request.urlopen(url))
-    return bodies
+    baseurl = f'{BASEURL}{namespace}/EventItems/{item.EventItemId}'
+    results = await gather(*(
+        get_json(client, f'{baseurl}/{subcat}') for subcat in ITEMSUBCATS
+    ))
+    extra.update(zip(ITEMSUBCATS, results))
+
+
+async def fetch_matter(client: httpx.AsyncClient, namespace: str, mid: int):
+    '''the matter and all its MATTERSUBCATS in one dict'''
+    baseurl = f'{BASEURL}{namespace}/Matters/{mid}'
+    matter, *results = await gather(
+        get_json(client, baseurl),
+        *(get_json(client, f'{baseurl}/{subcat}') for subcat in MATTERSUBCATS)
+    )
+    data = {'Matter': matter}
+    data.update(zip(MATTERSUBCATS, results))
+    return data
+
+
+async def add_matter_data(
+    client: httpx.AsyncClient,
+    namespace: str,
+    item: EventItem,
+    extra: Dict[str, Any],
+    matters: Dict[int, asyncio.Future],
+):
+    mid = item.EventItemMatterId
+    if not mid:
+        return
+    if mid not in matters:
+        # store the future, not the result, so items waiting on a matter that
+        # is already being fetched share the one request
+        matters[mid] = asyncio.ensure_future(
+            fetch_matter(client, namespace, mid)
+        )
+    extra.update(await matters[mid])
+
+
+def fetch_bodies(namespace: str, cache=True) -> List[Body]:
+    '''fetch_bodies_async for sync code'''
+    return asyncio.run(fetch_bodies_async(namespace, cache=cache))
+
+
+async def fetch_bodies_async(
+    namespace: str,
+    client: Optional[httpx.AsyncClient] = None,
+    cache=True,
+) -> List[Body]:
+    '''meeting body data. city council is 138, etc
+
+    reuses `client` when given, requests are paced and retried like all
+    the others either way
+    '''
+    url = f'{BASEURL}{namespace}/bodies'
+    params = {'$select': 'BodyId,BodyName'}
+    if client is None:
+        async with new_client(cache) as client:
+            response = await client.get(url, params=params, timeout=TM)
+    else:
+        response = await client.get(url, params=params, timeout=TM)
+    response.raise_for_status()
+    return decode(response, Body)
 
 
 if __name__ == '__main__':
@@ -195,8 +460,11 @@ if __name__ == '__main__':
         limit = 10
 
     async def fetch():
-        events = [e async for e in fetch_event_items(
-            namespace, limit=limit
-        )]
+        events = [
+            [event.to_api(), [item.to_api() for item in items]]
+            async for event, items in fetch_event_items(
+                namespace, limit=limit
+            )
+        ]
         print(json.dumps(events, indent=2))
     asyncio.run(fetch())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''counters and latency histograms for the stages of a fetch
+
+Recorded in process, no dependencies: legistar requests (latency, bytes,
+json decoding, cache hits), format_event, and sqlite statements and
+inserts. `legisearch ... --stats` prints a summary at the end of a
+command, legiscal serves the prometheus text format at /metrics.
+
+Updates take a lock, sqlalchemy runs aiosqlite's statements from its own
+threads.
+'''
+
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from contextlib import contextmanager
+import bisect
+import functools
+import threading
+import time
+
+
+# seconds, roughly log spaced from a fast sqlite statement to a slow request
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    inner = ','.join(
+        '{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in labels
+    )
+    return '{' + inner + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self.values.items())]
+
+    def summary(self) -> List[str]:
+        return [f'{self.name}{format_labels(key)} {value:g}'
+                for _, key, value in self.samples()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket..., +Inf count], sum
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, func):
+        '''decorator, observes every call of `func`'''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def samples(self):
+        samples: List[Tuple[str, Labels, float]] = []
+        bounds = self.buckets + (float('inf'),)
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(bounds, counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    samples.append((f'{self.name}_bucket',
+                                    key + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', key, total[0]))
+                samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+    def quantile(self, key: Labels, q: float) -> Optional[float]:
+        '''upper bound of the bucket holding the q quantile'''
+        counts, _ = self.values[key]
+        target = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return None
+
+    def summary(self) -> List[str]:
+        lines = []
+        with self.lock:
+            keys = sorted(self.values)
+        for key in keys:
+            counts, total = self.values[key]
+            count = sum(counts)
+            lines.append(
+                f'{self.name}{format_labels(key)} count={count} '
+                f'total={total[0]:.3f}s mean={total[0] / count * 1000:.2f}ms '
+                f'p50<={self.quantile(key, 0.5):g}s '
+                f'p99<={self.quantile(key, 0.99):g}s'
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[Counter, Histogram]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.add(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        '''prometheus text exposition format'''
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        '''the same numbers, for people'''
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.summary())
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'legistar_request_seconds',
+    'legistar api response time, per attempt, by endpoint and status',
+)
+RESPONSE_BYTES = registry.counter(
+    'legistar_response_bytes_total',
+    'bytes of json received from the legistar api, by endpoint',
+)
+RECORDS = registry.counter(
+    'legisearch_records_total',
+    'records through each stage, by stage',
+)
+DECODE_SECONDS = registry.histogram(
+    'legistar_json_decode_seconds',
+    'time spent parsing legistar responses, by endpoint',
+)
+CACHE = registry.counter(
+    'legistar_cache_total',
+    'response cache lookups, by result',
+)
+FORMAT_SECONDS = registry.histogram(
+    'legisearch_format_event_seconds',
+    'time in format_event per event',
+)
+INSERT_SECONDS = registry.histogram(
+    'legisearch_insert_seconds',
+    'time to write and commit one batch of events',
+)
+SQL_SECONDS = registry.histogram(
+    'legisearch_sql_seconds',
+    'sqlite statement time, by statement type',
+)
+
+
+def endpoint(path: str) -> str:
+    '''/v1/{namespace}/events/123/eventitems -> events/eventitems'''
+    parts = [p.lower() for p in path.split('/')[3:] if p and not p.isdigit()]
+    return '/'.join(parts) or 'other'
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+'''typed records for what the legistar api returns
+
+Events, items and bodies are NamedTuples: attribute access, no per record
+dict, and nothing downstream can change them by accident. Fields keep the
+api's names, so `event.EventId` is `event['EventId']` from the json.
+
+Events and bodies keep only the fields declared here, whatever else the
+api sends is dropped. Event items keep the rest in `extra` (votes, roll
+calls and matter details), so they go back out to the archive unchanged.
+Event and item fields the api left out are None.
+`from_api` / `to_api` convert from and to the api's json shape, which is
+also what the archive stores.
+'''
+
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from datetime import datetime
+
+
+class Event(NamedTuple):
+    EventId: int
+    EventBodyId: Optional[int] = None
+    EventBodyName: Optional[str] = None
+    EventDate: Optional[str] = None
+    EventTime: Optional[str] = None
+    EventLocation: Optional[str] = None
+    EventAgendaFile: Optional[str] = None
+    EventAgendaStatusName: Optional[str] = None
+    EventMinutesFile: Optional[str] = None
+    EventMinutesStatusId: Optional[int] = None
+    EventInSiteURL: Optional[str] = None
+    EventLastModifiedUtc: Optional[str] = None
+
+    @classmethod
+    def from_api(cls, data: Dict[str, Any]) -> 'Event':
+        return cls._make(map(data.get, cls._fields))
+
+    def to_api(self) -> Dict[str, Any]:
+        return without_none(self)
+
+
+class Attachment(NamedTuple):
+    MatterAttachmentName: Optional[str]
+    MatterAttachmentHyperlink: Optional[str]
+
+
+class EventItem(NamedTuple):
+    EventItemId: Optional[int] = None
+    EventItemLastModifiedUtc: Optional[str] = None
+    EventItemAgendaNumber: Optional[str] = None
+    EventItemActionText: Optional[str] = None
+    EventItemTitle: Optional[str] = None
+    EventItemMatterId: Optional[int] = None
+    EventItemMatterAttachments: Tuple[Attachment, ...] = ()
+    EventItemMatterStatus: Optional[str] = None
+    EventItemMatterType: Optional[str] = None
+    # votes, roll calls and matter details when the fetch asked for them
+    extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_api(cls, data: Dict[str, Any]) -> 'EventItem':
+        values = list(map(data.get, cls._fields))
+        values[ATTACHMENTS] = tuple(
+            Attachment(a.get('MatterAttachmentName'),
+                       a.get('MatterAttachmentHyperlink'))
+            for a in values[ATTACHMENTS] or ()
+        )
+        values[-1] = {
+            k: v for k, v in data.items() if k not in ITEMFIELDSET
+        } or None
+        return cls._make(values)
+
+    def to_api(self) -> Dict[str, Any]:
+        data = without_none(self._replace(extra=None))
+        data['EventItemMatterAttachments'] = [
+            a._asdict() for a in self.EventItemMatterAttachments
+        ]
+        data.update(self.extra or ())
+        return data
+
+
+ATTACHMENTS = EventItem._fields.index('EventItemMatterAttachments')
+ITEMFIELDSET = frozenset(EventItem._fields)
+
+
+class Body(NamedTuple):
+    BodyId: int
+    BodyName: str
+
+    @classmethod
+    def from_api(cls, data: Dict[str, Any]) -> 'Body':
+        return cls(data['BodyId'], data['BodyName'])
+
+    def to_api(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class Meeting(NamedTuple):
+    '''an event ready for the db, see fetch.format_event'''
+    event: Event
+    meeting_time: Optional[datetime]
+    items: List[EventItem]
+
+
+def without_none(record: NamedTuple) -> Dict[str, Any]:
+    return {k: v for k, v in zip(record._fields, record) if v is not None}
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+'''per-host request pacing, retries and circuit breaking for the legistar api
+
+Every client from `legistar.new_client` shares one token bucket per host,
+so fetching several namespaces at once does not multiply the load on
+webapi.legistar.com. The bucket adapts: it backs off hard when the server
+throttles us or slows down, and creeps back up to `RATE` while things are
+healthy.
+
+The latency it adapts to is from sending a request to getting the response
+headers, so waiting for a pooled connection under load is not mistaken for
+a slow server.
+
+Throttled (429) and server error responses are retried with jittered
+exponential backoff, honoring Retry-After. A Retry-After longer than
+MAXBACKOFF is not waited out, the response is returned as is. A namespace
+that keeps failing trips its circuit breaker, and requests for it fail fast
+for a while instead of piling onto a struggling server.
+'''
+
+from typing import Dict, Optional
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import time
+import random
+import asyncio
+import threading
+import httpx
+from legisearch import metrics
+
+
+RATE = 10.0  # max requests per second, per host
+BURST = 20  # requests allowed back to back before pacing kicks in
+MINRATE = 0.5  # never slow down further than this
+INCREASE = 0.1  # requests per second regained after each healthy response
+SLOWFACTOR = 3  # a response this many times slower than usual is a warning
+FASTENOUGH = 0.1  # seconds, a response quicker than this is never a warning
+RETRIES = 5
+BACKOFF = 1.0  # seconds, doubled on each retry
+MAXBACKOFF = 60.0
+RETRYSTATUS = {429, 500, 502, 503, 504}
+BREAKERFAILURES = 5  # requests in a row that ran out of retries
+BREAKERCOOLDOWN = 60.0  # seconds an open breaker stays open
+# requests a client hands to its connection pool at once, the rest wait
+# here. httpcore's pool rescans its whole queue for every request, so
+# thousands queued there at once, as enriching an agenda makes, stall
+# the loop
+INFLIGHT = 32
+
+
+class CircuitOpenError(httpx.TransportError):
+    '''the namespace has been failing, so the request was not sent'''
+
+
+class RateLimiter:
+    '''adaptive token bucket
+
+    Tokens can go negative, a caller that takes a token from an empty
+    bucket just waits its turn. Nothing here is bound to an event loop, so
+    one limiter can be shared by every loop and thread in the process.
+
+    `rate` moves between MINRATE and `max_rate`: halved when throttled,
+    trimmed when responses get slow, and raised a little on each healthy
+    response.
+    '''
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.latency: Optional[float] = None  # moving average, seconds
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        '''take a token, returns how many seconds to wait before using it'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def success(self, latency: float):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            slow = latency > max(self.latency * SLOWFACTOR, FASTENOUGH)
+            self.latency = 0.9 * self.latency + 0.1 * latency
+            if slow:
+                self.rate = max(MINRATE, self.rate * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + INCREASE)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(MINRATE, self.rate / 2)
+            # drop any saved up burst, it is what got us here
+            self.tokens = min(self.tokens, 0)
+
+
+class CircuitBreaker:
+    '''closed -> open after BREAKERFAILURES failures in a row
+
+    Once the cooldown passes one request is let through to test the water,
+    success closes the breaker and failure opens it again. A test that ends
+    without either, eg cancelled, must `release` so another can be tried.
+    '''
+
+    def __init__(self, failures=BREAKERFAILURES, cooldown=BREAKERCOOLDOWN):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened: Optional[float] = None
+        self.testing: Optional[object] = None  # owner of the test request
+        self.lock = threading.Lock()
+
+    def allow(self, owner: object = True) -> bool:
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.testing is not None \
+                    or time.monotonic() - self.opened < self.cooldown:
+                return False
+            self.testing = owner
+            return True
+
+    def release(self, owner: object):
+        '''`owner`'s test request ended with no outcome, if it was one'''
+        with self.lock:
+            if self.testing is owner:
+                self.testing = None
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.testing = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.testing = None
+            if self.failures >= self.max_failures:
+                self.opened = time.monotonic()
+
+
+limiters: Dict[str, RateLimiter] = {}
+breakers: Dict[str, CircuitBreaker] = {}
+_lock = threading.Lock()
+
+
+def limiter_for(host: str) -> RateLimiter:
+    with _lock:
+        if host not in limiters:
+            limiters[host] = RateLimiter(RATE, BURST)
+        return limiters[host]
+
+
+def breaker_for(namespace: str) -> CircuitBreaker:
+    with _lock:
+        if namespace not in breakers:
+            breakers[namespace] = CircuitBreaker()
+        return breakers[namespace]
+
+
+def configure(rate=RATE, burst=BURST):
+    '''change the pace of every host, existing limiters included'''
+    global RATE, BURST
+    RATE, BURST = rate, burst
+    with _lock:
+        for limiter in limiters.values():
+            limiter.rate = limiter.max_rate = rate
+            limiter.burst = burst
+
+
+def namespace_of(request: httpx.Request) -> str:
+    '''legistar paths look like /v1/{namespace}/...'''
+    parts = request.url.path.split('/')
+    return parts[2].lower() if len(parts) > 2 else ''
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    '''Retry-After in seconds, it can be either seconds or an http date'''
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def timer(request: httpx.Request) -> Dict[str, float]:
+    '''when `request` was last sent, once it has a connection
+
+    filled in by httpcore's trace extension, and stays empty with
+    transports that do not trace
+    '''
+    sent: Dict[str, float] = {}
+    traced = request.extensions.get('trace')
+
+    async def trace(name: str, info):
+        if name.endswith('.send_request_headers.started'):
+            sent['at'] = time.monotonic()
+        if traced is not None:
+            await traced(name, info)
+
+    request.extensions['trace'] = trace
+    return sent
+
+
+def backoff(attempt: int) -> float:
+    '''exponential with full jitter, so retries from many workers spread out'''
+    return random.uniform(0, min(MAXBACKOFF, BACKOFF * 2 ** attempt))
+
+
+class RateLimitTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        retries=RETRIES,
+        inflight=INFLIGHT,
+    ):
+        self.transport = transport
+        self.retries = retries
+        self.inflight = inflight
+        # made on first use, on the loop the client is used from
+        self.slots: Optional[asyncio.Semaphore] = None
+
+    async def handle_async_request(
+        self,
+        request: httpx.Request,
+    ) -> httpx.Response:
+        breaker = breaker_for(namespace_of(request))
+        # retries of a request the breaker let through are not checked,
+        # so a half-open probe gets its full set of attempts
+        if not breaker.allow(request):
+            raise CircuitOpenError(
+                f'too many failures for {namespace_of(request)}, '
+                'not sending requests for now',
+                request=request,
+            )
+        try:
+            return await self.send(request, breaker)
+        finally:
+            breaker.release(request)
+
+    async def send(
+        self,
+        request: httpx.Request,
+        breaker: CircuitBreaker,
+    ) -> httpx.Response:
+        limiter = limiter_for(request.url.host)
+        endpoint = metrics.endpoint(request.url.path)
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.inflight)
+        sent = timer(request)
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            started = time.monotonic()
+            sent.clear()
+            try:
+                async with self.slots:
+                    response = await self.transport.handle_async_request(
+                        request
+                    )
+            except httpx.TransportError:
+                metrics.REQUEST_SECONDS.observe(
+                    time.monotonic() - started, endpoint=endpoint,
+                    status='error'
+                )
+                if attempt >= self.retries:
+                    breaker.failure()
+                    raise
+                wait = backoff(attempt)
+            else:
+                metrics.REQUEST_SECONDS.observe(
+                    time.monotonic() - started, endpoint=endpoint,
+                    status=response.status_code
+                )
+                if response.status_code not in RETRYSTATUS:
+                    limiter.success(
+                        time.monotonic() - sent.get('at', started)
+                    )
+                    breaker.success()
+                    return response
+                if response.status_code in (429, 503):
+                    limiter.throttled()
+                if attempt >= self.retries:
+                    breaker.failure()
+                    return response
+                after = retry_after(response)
+                if after is not None and after > MAXBACKOFF:
+                    # retrying any sooner would only be throttled again
+                    return response
+                wait = backoff(attempt) if after is None else after
+                await response.aclose()
+            attempt += 1
+            await asyncio.sleep(wait)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -1,68 +1,244 @@
 # -*- coding: utf-8 -*-
 
+from typing import Optional, Sequence, Tuple
 import re
+import sys
 import json
+from datetime import datetime
 from collections import defaultdict
-from sqlalchemy import select, func
+from sqlalchemy import select, func, literal_column, tuple_, ColumnClause
 from legisearch import db
 
+HIGHLIGHT = ('[', ']')
+# names for `columns`. items.id is `id`, the event's id is `event_id`
+COLUMNS = {
+    **{c.name: c for c in db.events.c if c.name != 'id'},
+    **{c.name: c for c in db.items.c},
+}
+ORDERS = ('rank', 'newest', 'oldest')
+# the unique sort key of each order, pages continue after the last key seen.
+# meetings sort by event before item so the time index gives the order, and
+# a page is a seek into it. rank is computed, so every page of a rank order
+# still ranks and sorts every match
+ORDERKEYS = {
+    'rank': ('rank', 'id'),
+    'newest': ('meeting_time', 'event_id', 'id'),
+    'oldest': ('meeting_time', 'event_id', 'id'),
+}
 
-async def search(
-    namespace,
+
+def match_expression(search_string: str) -> str:
+    '''quote each word so user input can not break the fts5 query syntax
+
+    words are implicitly ANDed together
+    '''
+    return ' '.join(
+        '"{}"'.format(word.replace('"', '""'))
+        for word in search_string.split()
+    )
+
+
+def date_range(year, month=0):
+    '''start and end of a year or month, for index friendly range filters'''
+    year, month = int(year), int(month or 0)
+    if month:
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+    else:
+        start = datetime(year, 1, 1)
+        end = datetime(year + 1, 1, 1)
+    return start, end
+
+
+def projection(columns: Optional[Sequence[str]], computed=None):
+    '''the columns to select for `columns` names, all of COLUMNS when None'''
+    computed = computed or {}
+    if columns is None:
+        return [*COLUMNS.values(), *computed.values()]
+    available = {**COLUMNS, **computed}
+    unknown = [name for name in columns if name not in available]
+    if unknown:
+        raise ValueError(f'unknown columns: {", ".join(unknown)}')
+    return [available[name] for name in columns]
+
+
+def default_order(search_string='', order=None) -> str:
+    '''best match first for searches, else newest meeting first'''
+    if order is None:
+        return 'rank' if search_string else 'newest'
+    if order not in ORDERS:
+        raise ValueError(f'order must be one of {", ".join(ORDERS)}')
+    if order == 'rank' and not search_string:
+        raise ValueError('rank order needs a search string')
+    return order
+
+
+def cursor(row, order: str) -> str:
+    '''where the page ending with `row` stopped, for `after`'''
+    values = []
+    for name in ORDERKEYS[order]:
+        value = row[name]
+        values.append(value.isoformat() if isinstance(value, datetime)
+                      else repr(value))
+    return ','.join(values)
+
+
+def parse_cursor(after: str, order: str) -> Tuple:
+    try:
+        if order == 'rank':
+            rank, item_id = after.split(',')
+            return float(rank), int(item_id)
+        meeting_time, event_id, item_id = after.split(',')
+        return (datetime.fromisoformat(meeting_time), int(event_id),
+                int(item_id))
+    except ValueError:
+        raise ValueError(f'{after!r} is not a {order} cursor')
+
+
+def search_query(
     search_string='',
     body=0,
     year=0,
     month=0,
+    highlight=HIGHLIGHT,
+    columns: Optional[Sequence[str]] = None,
+    order: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
 ):
-    query = (
-        select(db.items, db.events)
-        .select_from(db.items)
-        .join(db.events, db.items.c.event_id == db.events.c.id)
-    )
+    '''`columns` limits what is selected, see COLUMNS. `snippet` and `rank`
+    can be asked for when there is a `search_string`
+
+    results are in `order`, see default_order. The columns of its key are
+    always selected, so `cursor` can be called on the last row of a page.
+    That cursor as `after` gives the next `limit` rows. For meeting time
+    orders that is an index seek, as long as the db has statistics (see
+    db.analyze). A rank ordered page costs as much as the matches there
+    are, wherever it starts.
+    '''
+    if month and not year:
+        raise ValueError('month needs a year')
+    order = default_order(search_string, order)
+    keys = ORDERKEYS[order]
+    if columns is not None:
+        columns = [*columns, *(k for k in keys if k not in columns)]
+    computed = {}
     if search_string:
-        low = search_string.lower()
-        query = query.where(func.instr(db.items.c.full_text_lower, low))
+        fts: ColumnClause = literal_column('items_fts')
+        rank = func.bm25(fts, *db.FTSWEIGHTS).label('rank')
+        snippet = func.snippet(fts, -1, *highlight, '...', 16).label('snippet')
+        computed = {'snippet': snippet, 'rank': rank}
+        query = (
+            select(*projection(columns, computed))
+            .select_from(db.items_fts)
+            .join(db.items, db.items.c.id == db.items_fts.c.rowid)
+            .join(db.events, db.items.c.event_id == db.events.c.id)
+            .where(fts.op('MATCH')(match_expression(search_string)))
+        )
+    else:
+        query = (
+            select(*projection(columns))
+            .select_from(db.items)
+            .join(db.events, db.items.c.event_id == db.events.c.id)
+        )
     if body:
-        result = await conn.execute(select(db.bodies))
-        bodies = {int(row[1]): row[0] for row in result}
-        body_id = bodies.get(body, body)
-        query = query.where(db.events.c.body_id == body_id)
-    if year:
-        if month:
-            ln, v = 8, f'{year}-{month}'
+        # body can be given by id or by name
+        if str(body).isdigit():
+            query = query.where(db.events.c.body_id == int(body))
         else:
-            ln, v = 5, str(year)
-        query = query.where(func.substr(db.events.c.meeting_time, 0, ln) == v)
+            query = query.where(db.events.c.body_id == (
+                select(db.bodies.c.id)
+                .where(db.bodies.c.name == body)
+                .scalar_subquery()
+            ))
+    if year:
+        start, end = date_range(year, month)
+        query = query.where(
+            db.events.c.meeting_time >= start,
+            db.events.c.meeting_time < end,
+        )
+    # events.id is items.event_id, but only it is in the events_time index
+    available = {**COLUMNS, **computed, 'event_id': db.events.c.id}
+    key = [available[k] for k in keys]
+    if order == 'newest':
+        query = query.order_by(*(k.desc() for k in key))
+    else:
+        query = query.order_by(*key)
+    if after:
+        position = tuple_(*key)
+        values = tuple_(*parse_cursor(after, order))
+        query = query.where(
+            position < values if order == 'newest' else position > values
+        )
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+async def search(
+    namespace,
+    search_string='',
+    body=0,
+    year=0,
+    month=0,
+    highlight=HIGHLIGHT,
+    columns: Optional[Sequence[str]] = None,
+    order: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    batch_size=db.STREAMBATCH,
+):
+    '''items matching `search_string`, best bm25 match first
+
+    each row has a `snippet` of the matching text, with the matched words
+    wrapped in `highlight`. Rows are streamed `batch_size` at a time.
+    See search_query for `order`, `after` and `limit`.
+    '''
+    query = search_query(
+        search_string, body, year, month, highlight, columns,
+        order, after, limit,
+    )
     async with db.new_connection(namespace) as conn:
-        print(query)
-        result = await conn.execute(query)
-        for row in result:
+        async for row in await db.stream(conn, query, batch_size):
             yield row._mapping
 
 
-async def all_minutes(namespace, body_id):
-    query = (
-        select(db.items, db.events)
+def all_minutes_query(body_id, columns: Optional[Sequence[str]] = None):
+    return (
+        select(*projection(columns))
         .select_from(db.items)
         .join(db.events, db.items.c.event_id == db.events.c.id)
         .where(db.events.c.body_id == body_id)
         .order_by(db.events.c.meeting_time, db.items.c.id)
     )
+
+
+async def all_minutes(
+    namespace,
+    body_id,
+    columns: Optional[Sequence[str]] = None,
+    batch_size=db.STREAMBATCH,
+):
+    '''every item of a body, oldest meeting first, streamed'''
+    query = all_minutes_query(body_id, columns)
     async with db.new_connection(namespace) as conn:
-        result = await conn.execute(query)
-        for row in result:
+        async for row in await db.stream(conn, query, batch_size):
             yield row._mapping
 
 
+REPORTCOLUMNS = ('event_id', 'meeting_time', 'agenda_number', 'title',
+                 'full_text_lower')
+
+
 async def report(namespace, body_id):
-    rows = all_minutes(namespace, body_id)
+    rows = all_minutes(namespace, body_id, REPORTCOLUMNS)
     event_id = None
     titles = defaultdict(list)
     async for row in rows:
         if row['meeting_time'].year < 2023:
             continue
-        if row['id_1'] != event_id:
-            event_id = row['id_1']
+        if row['event_id'] != event_id:
+            event_id = row['event_id']
             print()
             print(row['meeting_time'].strftime('%a %d %b %Y, %I:%M%p'))
             print(f" -- {row['title']} -- ")
@@ -70,16 +246,17 @@ async def report(namespace, body_id):
             if row['agenda_number'] in ('1.', '2.'):
                 continue
             print(row["full_text_lower"])
-        if row.get('title') and re.match('\d\.\d', row['agenda_number']):
+        if row.get('title') and re.match(r'\d\.\d', row['agenda_number']):
             titles[row['title'].strip().lower()].append(f"{row['agenda_number']}, {row['meeting_time'].year}, {row['meeting_time'].month}")
 
     json.dump(dict(sorted(titles.items())), sys.stdout)
 
 
 if __name__ == '__main__':
-    import sys, asyncio
+    import asyncio
     async def test():
         namespace = sys.argv[1]
         bid = sys.argv[2]
         await report(namespace, bid)
+        await db.dispose_engines()
     asyncio.run(test())
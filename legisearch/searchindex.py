@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''build MiniSearch indexes in python, so the browser does not have to
+
+The output is what `MiniSearch#toJSON` produces (serializationVersion 2,
+minisearch 7.x), and loads with `MiniSearch.loadJSON(json, options)` as
+long as `options.fields` matches. Tokenizing and term processing copy
+MiniSearch's defaults: split on newlines, unicode separators and
+punctuation, then lowercase.
+'''
+
+from typing import Any, Dict, List, Mapping, Optional, Pattern
+from functools import lru_cache
+import re
+import sys
+import unicodedata
+
+
+SERIALIZATIONVERSION = 2
+
+
+@lru_cache(maxsize=None)
+def separators() -> Pattern:
+    '''python's re has no \\p{..}, so spell out [\\n\\r\\p{Z}\\p{P}]+'''
+    ranges = []
+    start = None
+    for cp in range(sys.maxunicode + 2):
+        is_sep = cp <= sys.maxunicode and (
+            cp in (10, 13) or unicodedata.category(chr(cp))[0] in 'ZP'
+        )
+        if is_sep and start is None:
+            start = cp
+        elif not is_sep and start is not None:
+            ranges.append(
+                re.escape(chr(start)) if start == cp - 1
+                else f'{re.escape(chr(start))}-{re.escape(chr(cp - 1))}'
+            )
+            start = None
+    return re.compile(f'[{"".join(ranges)}]+')
+
+
+def tokenize(text: str) -> List[str]:
+    return separators().split(text)
+
+
+class SearchIndex:
+    '''accumulates documents into MiniSearch's serialized form
+
+    documents can only be added, which keeps short ids equal to insertion
+    order, same as a fresh MiniSearch instance
+    '''
+
+    def __init__(self, fields):
+        self.field_ids = {field: i for i, field in enumerate(fields)}
+        self.document_ids: Dict[int, Any] = {}
+        self.field_length: Dict[int, List[Optional[int]]] = {}
+        self.average_field_length = [0.0] * len(self.field_ids)
+        # term -> field id -> short id -> term frequency
+        self.index: Dict[str, Dict[int, Dict[int, int]]] = {}
+
+    def __len__(self):
+        return len(self.document_ids)
+
+    def add(self, doc_id, document: Mapping[str, Any]):
+        short_id = len(self.document_ids)
+        self.document_ids[short_id] = doc_id
+        lengths: List[Optional[int]] = [None] * len(self.field_ids)
+        for field, field_id in self.field_ids.items():
+            value = document.get(field)
+            if value is None:
+                continue
+            tokens = tokenize(str(value))
+            # MiniSearch counts distinct raw tokens, before lowercasing
+            length = len(set(tokens))
+            lengths[field_id] = length
+            average = self.average_field_length[field_id]
+            self.average_field_length[field_id] = (
+                (average * short_id + length) / (short_id + 1)
+            )
+            for token in tokens:
+                term = token.lower()
+                if not term:
+                    continue
+                postings = self.index.setdefault(term, {}) \
+                    .setdefault(field_id, {})
+                postings[short_id] = postings.get(short_id, 0) + 1
+        # a js array that never got its last fields set is shorter
+        while lengths and lengths[-1] is None:
+            lengths.pop()
+        self.field_length[short_id] = lengths
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'documentCount': len(self.document_ids),
+            'nextId': len(self.document_ids),
+            'documentIds': self.document_ids,
+            'fieldIds': self.field_ids,
+            'fieldLength': self.field_length,
+            'averageFieldLength': self.average_field_length,
+            'storedFields': {},
+            'dirtCount': 0,
+            'index': list(self.index.items()),
+            'serializationVersion': SERIALIZATIONVERSION,
+        }
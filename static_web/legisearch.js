@@ -40,28 +40,29 @@ const filters = (() => {
     years.clear();
   };
 
-  const makeElements = (results) => {
+  // filters come from the manifest, so they can pick shards that are not loaded yet
+  const makeElements = (manifest) => {
     const bids = new Set(),
           yrs = new Set(),
           bEl = document.getElementById('body-filter'),
           yEl = document.getElementById('year-filter');
     bEl.innerHTML = '';
     yEl.innerHTML = '';
-    for (const res of results) {
-      bids.add(res.b_id);
-      yrs.add(+res.year);
+    clear();
+    for (const shard of manifest.shards) {
+      bids.add(shard.body);
+      yrs.add(shard.year);
     }
-    for (const yr of Array.from(yrs).toSorted()) {
+    const sortedYears = Array.from(yrs).toSorted();
+    for (const yr of sortedYears) {
       makeFilterEl(years, yEl, yr.toString());
     }
-    for (const yr of years.difference(yrs)) {
-      years.delete(yr);
-    }
     for (const bid of bids) {
-      makeFilterEl(bodyIds, bEl, bid, db.bodies[bid]);
+      makeFilterEl(bodyIds, bEl, bid, manifest.bodies[bid]);
     }
-    for (const bid of bodyIds.difference(bids)) {
-      bodyIds.delete(bid);
+    // start with only the latest year, so first load stays small
+    if (sortedYears.length > 0) {
+      yEl.lastChild.click();
     }
   };
 
@@ -104,11 +105,160 @@ const filters = (() => {
     return true;
   };
 
+  const filterShard = (shard) => {
+    return (bodyIds.size === 0 || bodyIds.has(shard.body)) &&
+      (years.size === 0 || years.has(shard.year.toString()));
+  };
+
   return {
     makeElements: makeElements,
     clear: clear,
-    fn: filterResult
+    fn: filterResult,
+    shardFn: filterShard
+  };
+})();
+
+
+// decoder for shards written with `legisearch generate --format compact`,
+// see CompactShard in legisearch/export.py. the columns are kept as they
+// are, item objects are only made for the ids that get looked up
+const compact = (() => {
+  const undelta = (values) => {
+    let previous = 0;
+    return values.map((value) => (previous += value));
+  };
+
+  // urls are stored as a prefix index and the rest, both null for no url
+  const joinUrl = (strings, prefix, rest) => {
+    return prefix === null ? null : strings[prefix] + rest;
+  };
+
+  const url = (strings, columns, name, i) => {
+    return joinUrl(strings, columns[name + '_p'][i], columns[name][i]);
+  };
+
+  const time = (seconds) => new Date(seconds * 1000).toISOString().replace('T', ' ').slice(0, 19);
+
+  const decode = (shard, bodies) => {
+    const strings = shard.strings,
+          events = shard.events,
+          items = shard.items,
+          eventOf = undelta(items.event),
+          times = undelta(events.time),
+          ids = undelta(items.id),
+          rows = new Map(ids.map((id, row) => [id, row]));
+
+    const get = (id) => {
+      const row = rows.get(id);
+      if (row === undefined) {
+        return undefined;
+      }
+      const e = eventOf[row],
+            meetingTime = time(times[e]),
+            attach = {},
+            flat = items.attach[row] || [];
+      for (let i = 0; i < flat.length; i += 3) {
+        attach[strings[flat[i]]] = joinUrl(strings, flat[i + 1], flat[i + 2]);
+      }
+      const str = (index) => index === null ? null : strings[index];
+      return {
+        id: id,
+        b_id: shard.b_id,
+        b_name: bodies[shard.b_id] || shard.b_id.toString(),
+        agenda: url(strings, events, 'agenda', e),
+        minutes: url(strings, events, 'minutes', e),
+        insite: url(strings, events, 'insite', e),
+        meeting_time: meetingTime,
+        year: meetingTime.slice(0, 4),
+        month: meetingTime.slice(5, 7),
+        minutes_status: events.minutes_status[e],
+        a_num: str(items.a_num[row]),
+        text: items.text[row],
+        title: items.title[row],
+        matter: {
+          id: items.matter_id[row],
+          status: str(items.matter_status[row]),
+          attach: attach,
+          type: str(items.matter_type[row])
+        }
+      };
+    };
+
+    return { ids: ids, get: get };
+  };
+
+  return { decode: decode };
+})();
+
+
+// items are split into one file per meeting body per year, see legisearch/export.py
+// only the shards matching the current filters are downloaded. every shard
+// comes with a prebuilt MiniSearch index, so nothing is indexed in the browser
+const shards = (() => {
+  const loaded = new Set();
+
+  const reset = () => {
+    loaded.clear();
+    db.indexes = [];
+    db.items = new Map();
   };
+
+  // db.items maps an item id to the decoded shard that can make the item
+  const addItems = (data) => {
+    let source;
+    if (db.manifest.format === 'compact') {
+      source = compact.decode(data, db.manifest.bodies);
+    } else {
+      const byId = new Map(data.map((item) => [item.id, item]));
+      source = { ids: byId.keys(), get: (id) => byId.get(id) };
+    }
+    for (const id of source.ids) {
+      db.items.set(id, source);
+    }
+  };
+
+  // the index is only searched once the items it points at can be looked up
+  const loadShard = (shard) => {
+    const items = fetch(shard.path).then((resp) => resp.json());
+    const index = fetch(shard.index).then((resp) => resp.text());
+    return Promise.all([items, index]).then(([data, json]) => {
+      addItems(data);
+      db.indexes.push(MiniSearch.loadJSON(json, db.manifest.index));
+    });
+  };
+
+  const load = () => {
+    const wanted = db.manifest.shards.filter(filters.shardFn)
+      .filter((shard) => !loaded.has(shard.path));
+    return Promise.all(wanted.map((shard) => {
+      loaded.add(shard.path);
+      return loadShard(shard);
+    }));
+  };
+
+  // each shard is its own index, and bm25 scores depend on the document
+  // count and lengths of the shard they came from. so scores are made
+  // relative to the shard's best hit before results are merged
+  const merge = (results) => {
+    return results.flatMap((shardResults) => {
+      const best = shardResults.reduce((max, res) => Math.max(max, res.score), 0);
+      return shardResults.map((res) => ({ ...res, score: res.score / best }));
+    }).toSorted((a, b) => b.score - a.score);
+  };
+
+  const search = (query) => {
+    return merge(db.indexes.map((index) => index.search(query)))
+      .flatMap((res) => {
+        const source = db.items.get(res.id);
+        return source === undefined ? [] : [source.get(res.id)];
+      });
+  };
+
+  const autoSuggest = (query, options) => {
+    return merge(db.indexes.map((index) => index.autoSuggest(query, options)));
+  };
+
+  return { load: load, reset: reset, search: search, autoSuggest: autoSuggest };
 })();
 
 
@@ -209,7 +359,9 @@ const makeResultElement = (res) => {
     atts.forEach((name) => {
       const link = document.createElement('a');
       link.textContent = '\u{1F4CE}' + name;
-      link.setAttribute('href', res.matter.attach[name]);
+      if (res.matter.attach[name] !== null) {
+        link.setAttribute('href', res.matter.attach[name]);
+      }
       atta.appendChild(link);
     });
     result.appendChild(atta);
@@ -231,35 +383,22 @@ const makeResultElement = (res) => {
 };
 
 const postFetch = () => {
-  db.search = new MiniSearch({
-    fields: ['title', 'action_text', 'b_name'],
-    storeFields: ['text', 'attachments', 'title',
-      'a_num', 'matter', 'meeting_time', 'year', 'month',
-      'b_id', 'b_name', 'agenda', 'minutes', 'insite']
-  });
-  db.search.addAll(db.items);
-  filters.clear();
+  shards.reset();
+  filters.makeElements(db.manifest);
 };
 
 const jurisdictions = (() => {
   let selectedJurisdiction = 'mountainview';
 
   const loadData = (jurisdiction) => {
-    return Promise.all([
-      fetch(`${jurisdiction}.items.json`)
-        .then((resp) => resp.json())
-        .then((itjson) => {
-          db.items = itjson;
-        }),
-      fetch(`${jurisdiction}.bodies.json`)
-        .then((resp) => resp.json())
-        .then((bjson) => {
-          db.bodies = bjson.reduce((o, b) => {o[b.id] = b.name; return o; }, {});
-        })
-    ]).then(() => {
-      postFetch();
-      onType();
-    });
+    return fetch(`${jurisdiction}.manifest.json`)
+      .then((resp) => resp.json())
+      .then((manifest) => {
+        db.manifest = manifest;
+        db.bodies = manifest.bodies;
+        // selecting the default year filter loads its shards and searches
+        postFetch();
+      });
   };
 
   const loadJurisdictions = () => {
@@ -312,7 +451,7 @@ const displaySuggestions = (suggestions) => {
 };
 
 const suggest = (query) => {
-  const suggestions = db.search.autoSuggest(
+  const suggestions = shards.autoSuggest(
     query,
     {
       prefix: true,
@@ -333,23 +472,27 @@ const onType = () => {
   if (value.length <= 2) {
     return;
   }
-  const results = db.search.search(value);
+  const results = shards.search(value);
   if (results.length > 0) {
-    filters.makeElements(results);
     state.results.items = results;
-    onFilterChange();
+    renderFiltered();
   } else {
     suggest(value);
   }
 };
 
-const onFilterChange = () => {
+const renderFiltered = () => {
   const resEl = document.getElementById('results');
   resEl.innerHTML = '';
   state.renderQueue = state.results.items.filter(filters.fn);
   renderResults(resEl, settings.maxResults);
 };
 
+const onFilterChange = () => {
+  // new shards may have been added to the index, so search again
+  shards.load().then(onType);
+};
+
 const onload = () => {
   jurisdictions.load().then(() => {
     const acEl = document.getElementById('autoComplete');
@@ -0,0 +1,48 @@
+from datetime import date, datetime, time, timedelta
+import asyncio
+import pytest
+from benchmarks.mocklegistar import Dataset, MockLegistar
+from legisearch import cache, db, legistar, ratelimit
+
+
+@pytest.fixture
+def run():
+    '''run a coroutine in a new loop, closing its db engines after'''
+    def run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await db.dispose_engines()
+        return asyncio.run(main())
+    return run
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''dbs and archives are written to the working directory'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, 'CACHEFILE', '')
+    monkeypatch.setattr(cache, '_cache', None)
+    return tmp_path
+
+
+@pytest.fixture
+def mock_legistar(workdir, monkeypatch):
+    '''a local legistar with a few events, fetched without pacing'''
+    monkeypatch.setattr(ratelimit, 'RATE', 1000.0)
+    monkeypatch.setattr(ratelimit, 'BACKOFF', 0.01)
+    monkeypatch.setattr(ratelimit, 'limiters', {})
+    monkeypatch.setattr(ratelimit, 'breakers', {})
+    with MockLegistar(Dataset(6)) as mock:
+        monkeypatch.setattr(legistar, 'BASEURL', mock.baseurl)
+        yield mock
+
+
+@pytest.fixture
+def upcoming(mock_legistar, monkeypatch):
+    '''a local legistar whose meetings have not happened yet'''
+    start = datetime.combine(date.today() + timedelta(1), time(18))
+    with MockLegistar(Dataset(6, start=start)) as mock:
+        monkeypatch.setattr(legistar, 'BASEURL', mock.baseurl)
+        yield mock
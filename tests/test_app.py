@@ -0,0 +1,48 @@
+import subprocess
+import sys
+import httpx
+import pytest
+
+
+@pytest.fixture
+def client(monkeypatch):
+    from legiscal import app, cache
+    monkeypatch.setattr(app, 'KNOWN_NAMESPACES', {})
+    monkeypatch.setattr(app, 'calendars', cache.CalendarCache())
+    return app.app.test_client()
+
+
+def test_import_starts_nothing():
+    # in a fresh interpreter, other tests have already imported the app
+    threads = subprocess.run(
+        [sys.executable, '-c', 'import threading, legiscal.app; '
+         'print(threading.active_count())'],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    assert threads.strip() == '1'
+
+
+def test_body_ids_must_be_numbers(client):
+    assert client.get('/c/test?b=council').status_code == 400
+
+
+def test_streamed_calendar_etag_is_kept(upcoming, client):
+    streamed = client.get('/c/test')
+    assert streamed.status_code == 200
+    etag = streamed.headers['ETag']
+    assert streamed.data.count(b'BEGIN:VEVENT') == 6
+
+    cached = client.get('/c/test', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+
+
+def test_calendar_header_failure_is_503(client, monkeypatch):
+    from legiscal import app
+
+    async def broken(namespace, **kwargs):
+        raise httpx.ConnectError('legistar is down')
+        yield b''
+    monkeypatch.setattr(app, 'stream_ical', broken)
+    resp = client.get('/c/test')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After']
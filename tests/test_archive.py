@@ -0,0 +1,35 @@
+from legisearch import archive
+from legisearch.models import Body, Event
+
+NAMESPACE = 'test'
+
+
+def add(event_id, title, bodies=None):
+    with archive.Archive(NAMESPACE, enabled=True) as archived:
+        if bodies:
+            archived.add_bodies(bodies)
+        archived.add(Event(EventId=event_id, EventBodyName=title), [])
+
+
+def test_latest_copy_of_each_event(workdir):
+    add(1, 'first', [Body(1, 'Council')])
+    add(2, 'second')
+    add(1, 'edited', [Body(1, 'City Council')])
+    lines, bodies = archive.latest(NAMESPACE)
+    assert sorted(lines) == [1, 2]
+    text = dict(archive.read(NAMESPACE))
+    assert archive.records(text[lines[1]])[0].EventBodyName == 'edited'
+    assert bodies == [Body(1, 'City Council')]
+
+
+def test_cut_short_archive_keeps_what_came_before(workdir, capsys):
+    add(1, 'first')
+    path = workdir / archive.archive_file(NAMESPACE)
+    first = path.stat().st_size
+    add(2, 'second')
+    data = path.read_bytes()
+    # as if killed while writing the last run's gzip member
+    path.write_bytes(data[:first + (len(data) - first) // 2])
+    lines, _ = archive.latest(NAMESPACE)
+    assert list(lines) == [1]
+    assert 'cut short' in capsys.readouterr().err
@@ -0,0 +1,26 @@
+import asyncio
+from legiscal import background
+from legisearch import db
+
+
+def test_engines_are_reused_across_request_loops(workdir):
+    async def engine():
+        async with db.new_connection('test') as conn:
+            await conn.exec_driver_sql('SELECT 1')
+        return db.get_engine('test')
+
+    async def view():
+        # what flask does for each async view
+        return await background.run(engine())
+
+    engines = {asyncio.run(view()) for _ in range(3)}
+    assert len(engines) == 1
+    background.submit(db.dispose_engines()).result()
+
+
+def test_iterate():
+    async def numbers():
+        for n in range(3):
+            yield n
+
+    assert list(background.iterate(numbers())) == [0, 1, 2]
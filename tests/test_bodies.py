@@ -0,0 +1,18 @@
+import asyncio
+import pytest
+from legiscal import bodies
+
+
+def test_timeout_does_not_cancel_the_fetch(monkeypatch):
+    monkeypatch.setattr(bodies, 'TIMEOUT', 0.05)
+    cache = bodies.BodyCache()
+
+    async def fetch(namespace):
+        await asyncio.sleep(0.2)
+        return {'City Council': 138}
+    monkeypatch.setattr(cache, 'fetch', fetch)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(cache.get('test'))
+    cache.pending['test'].result(5)
+    assert asyncio.run(cache.get('test')) == {'City Council': 138}
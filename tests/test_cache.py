@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+import pytest
+from legiscal.cache import CalendarCache
+
+KEY = ('test', ())
+
+
+def test_builds_once_without_holding_the_lock():
+    cache = CalendarCache()
+    started = threading.Event()
+    release = threading.Event()
+    builds = []
+
+    async def build():
+        builds.append(1)
+        assert not cache.lock.locked()
+        started.set()
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+        return b'calendar'
+
+    results = []
+
+    def request():
+        results.append(asyncio.run(cache.get(KEY, build)))
+
+    first = threading.Thread(target=request)
+    first.start()
+    started.wait(5)
+    # while the first build runs, other keys and lookups are not held up
+    assert cache.lookup(('other', ())) is None
+    second = threading.Thread(target=request)
+    second.start()
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert len(builds) == 1
+    assert results[0] is results[1]
+    assert results[0].body == b'calendar'
+
+
+def test_streamed_etag_kept_while_unchanged():
+    cache = CalendarCache()
+    etag, modified, chunks = cache.stream(KEY, lambda: iter([b'a', b'b']))
+    assert b''.join(chunks) == b'ab'
+    entry = cache.lookup(KEY)
+    assert (entry.etag, entry.modified) == (etag, modified)
+
+    same = cache.store(KEY, b'ab')
+    assert (same.etag, same.modified) == (etag, modified)
+    changed = cache.store(KEY, b'abc')
+    assert changed.etag != etag
+
+
+def test_failed_build_falls_back_to_stale_entry(monkeypatch):
+    cache = CalendarCache()
+    stale = cache.store(KEY, b'old')
+    monkeypatch.setattr('legiscal.cache.TTL', 0)
+
+    async def build():
+        raise OSError('legistar is down')
+
+    assert asyncio.run(cache.get(KEY, build)) is stale
+    assert not cache.building
+
+
+def test_misses_while_streaming_wait_for_the_stream():
+    cache = CalendarCache()
+    etag, _, chunks = cache.stream(KEY, lambda: iter([b'a', b'b']))
+    assert cache.stream(KEY, lambda: iter([b'again'])) is None
+
+    async def build():
+        raise AssertionError('the stream is the build')
+
+    waiting = []
+    thread = threading.Thread(
+        target=lambda: waiting.append(asyncio.run(cache.get(KEY, build)))
+    )
+    thread.start()
+    time.sleep(0.1)  # let it find the stream under way
+    assert b''.join(chunks) == b'ab'
+    thread.join(5)
+    assert waiting[0].body == b'ab'
+    assert waiting[0].etag == etag
+
+
+def test_hung_up_stream_is_not_stored():
+    cache = CalendarCache()
+    _, _, chunks = cache.stream(KEY, lambda: iter([b'a', b'b']))
+    next(chunks)
+    chunks.close()
+    assert cache.lookup(KEY) is None
+    assert not cache.building
+
+    async def build():
+        return b'rebuilt'
+    assert asyncio.run(cache.get(KEY, build)).body == b'rebuilt'
+
+
+def test_failed_stream_is_logged_and_not_stored(capsys):
+    cache = CalendarCache()
+
+    def produce():
+        yield b'header'
+        raise OSError('legistar went away')
+
+    _, _, chunks = cache.stream(KEY, produce)
+    with pytest.raises(OSError):
+        b''.join(chunks)
+    assert 'failed part way' in capsys.readouterr().err
+    assert cache.lookup(KEY) is None
+    assert not cache.building
@@ -0,0 +1,65 @@
+from datetime import date, datetime, time, timedelta, timezone
+from benchmarks.mocklegistar import BODIES
+from legisearch import dates, db
+from legisearch.fetch import fetch_more_events, sync_events, LASTSYNC
+from legiscal import cal
+
+NAMESPACE = 'test'
+
+
+def test_db_used_only_when_synced(mock_legistar, run):
+    run(fetch_more_events(NAMESPACE, limit=6, cache=False))
+    # fetched, but nothing says the upcoming meetings are current
+    assert run(cal.fetch_db_events(NAMESPACE, maxage=cal.MAXAGE)) is None
+    assert run(cal.fetch_db_events(NAMESPACE)) == []
+
+    run(sync_events(NAMESPACE))
+    assert run(cal.fetch_db_events(NAMESPACE, maxage=cal.MAXAGE)) == []
+
+
+def test_db_not_used_when_stale_or_missing_bodies(mock_legistar, run):
+    run(fetch_more_events(NAMESPACE, limit=6, cache=False))
+    run(sync_events(NAMESPACE))
+    body_id = str(next(iter(BODIES)))
+    assert run(cal.fetch_db_events(
+        NAMESPACE, [body_id], maxage=cal.MAXAGE
+    )) == []
+    assert run(cal.fetch_db_events(
+        NAMESPACE, [body_id, '999999'], maxage=cal.MAXAGE
+    )) is None
+
+    async def age():
+        synced = datetime.now(timezone.utc) - cal.MAXAGE - timedelta(1)
+        async with db.new_connection(NAMESPACE) as conn:
+            await conn.execute(db.sync_state.insert(), {
+                'key': LASTSYNC, 'value': synced.isoformat()
+            })
+    run(age())
+    assert run(cal.fetch_db_events(NAMESPACE, maxage=cal.MAXAGE)) is None
+
+
+def test_streamed_and_built_calendars_match(upcoming, run):
+    bodies = [str(b) for b in BODIES][:2]
+    streamed = run(cal.render_ical(NAMESPACE, bodies=bodies, source='api'))
+    built = run(cal.gen_ical(NAMESPACE, bodies=bodies[::-1], source='api'))
+    assert streamed.count(b'BEGIN:VEVENT') == 4
+    assert built.to_ical() == streamed
+
+
+def test_db_events_parse_without_dateutil(upcoming, run, monkeypatch):
+    run(fetch_more_events(NAMESPACE, limit=6, cache=False))
+    run(sync_events(NAMESPACE))
+    events = run(cal.fetch_db_events(NAMESPACE, maxage=cal.MAXAGE))
+    assert len(events) == 6
+
+    def fallback(text):
+        raise AssertionError(f'{text!r} went to dateutil')
+    monkeypatch.setattr(dates, 'parse', fallback)
+    dates.parse_date.cache_clear()
+    dates.parse_time.cache_clear()
+    for event, _ in events:
+        api = upcoming.dataset.events[event.EventId - 1]
+        assert dates.meeting_time(event.EventDate, event.EventTime) == \
+            datetime.combine(date.fromisoformat(api['EventDate'][:10]),
+                             time(13, 30))
+        assert api['EventTime'] == '1:30 PM'
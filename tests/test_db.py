@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+from legisearch import db, metrics
+
+NAMESPACE = 'test'
+
+
+def test_migrate_indexes_items_missing_from_fts(workdir, run):
+    async def partly_indexed():
+        async with db.new_connection(NAMESPACE) as conn:
+            await db.recreate_tables(NAMESPACE, conn)
+            await conn.execute(db.items.insert(), [
+                {'id': i, 'event_id': 1, 'title': f'title {i}'}
+                for i in range(1, 11)
+            ])
+            # as if a backfill had been interrupted after a few rows
+            await conn.execute(text('DELETE FROM items_fts WHERE rowid > 3'))
+        counts = []
+        for backfill in (False, True):
+            await db.create_tables(NAMESPACE, backfill=backfill)
+            counts.append(await fts_count())
+        return counts
+
+    # a plain create_tables leaves the gap for `db migrate`
+    assert run(partly_indexed()) == [3, 10]
+
+
+def test_new_fts_table_indexes_existing_items(workdir, run):
+    async def unindexed():
+        async with db.new_connection(NAMESPACE) as conn:
+            await db.recreate_tables(NAMESPACE, conn)
+            await conn.execute(db.items.insert(), [
+                {'id': i, 'event_id': 1, 'title': f'title {i}'}
+                for i in range(1, 11)
+            ])
+            # as if the db was made before there was a full text index
+            await conn.execute(text('DROP TABLE items_fts'))
+        await db.create_tables(NAMESPACE)
+        return await fts_count()
+
+    assert run(unindexed()) == 10
+
+
+async def fts_count():
+    async with db.new_connection(NAMESPACE) as conn:
+        result = await conn.execute(
+            select(func.count()).select_from(db.items_fts)
+        )
+        return result.scalar()
+
+
+def test_failed_statement_leaves_no_timing(workdir, run, monkeypatch):
+    observed = []
+    monkeypatch.setattr(
+        metrics.SQL_SECONDS, 'observe',
+        lambda value, **labels: observed.append((value, labels))
+    )
+
+    async def fail_then_select():
+        async with db.new_connection(NAMESPACE, begin=False) as conn:
+            with pytest.raises(OperationalError):
+                await conn.execute(text('SELECT * FROM missing'))
+            await conn.rollback()
+            await conn.execute(text('SELECT 1'))
+            raw = await conn.get_raw_connection()
+            return dict(raw.info)
+
+    info = run(fail_then_select())
+    assert 'started' not in info
+    assert [labels for _, labels in observed] == [{'statement': 'select'}]
+    assert 0 <= observed[0][0] < 1
@@ -0,0 +1,25 @@
+from legisearch.export import CompactShard
+
+
+def row(attach):
+    return {
+        'id': 1, 'meeting_time': '2020-01-02 10:00:00',
+        'minutes_status': 'Final', 'agenda': 'http://x/a.pdf',
+        'minutes': None, 'insite': None, 'a_num': '1', 'title': 't',
+        'text': None,
+        'matter': {'id': 3, 'status': None, 'type': None, 'attach': attach},
+    }
+
+
+def test_compact_attachment_without_url():
+    shard = CompactShard(7, 2020)
+    shard.add(row({'good': 'http://x/f/b.pdf', 'broken': None}))
+    data = shard.to_json()
+    strings = data['strings']
+    name, prefix, rest, *broken = data['items']['attach'][0]
+    assert strings[name] == 'good'
+    assert strings[prefix] + rest == 'http://x/f/b.pdf'
+    # no url is a null prefix, not an index the decoder would look up
+    assert strings[broken[0]] == 'broken'
+    assert broken[1:] == [None, None]
+    assert None not in strings
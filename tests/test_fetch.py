@@ -0,0 +1,107 @@
+from datetime import datetime
+import os
+import sqlite3
+from sqlalchemy import select
+from legisearch import archive, db
+from legisearch.fetch import fetch_more_events, sync_events, fetch_marks, \
+    rebuild, EVENTMARK
+
+NAMESPACE = 'test'
+
+
+async def stored(query):
+    async with db.new_connection(NAMESPACE) as conn:
+        return (await conn.execute(query)).all()
+
+
+async def marks():
+    async with db.new_connection(NAMESPACE) as conn:
+        return await fetch_marks(conn)
+
+
+def edit(mock, event_id, title, modified):
+    '''change an event's first item on the mock server'''
+    event = mock.dataset.events[event_id - 1]
+    event['EventLastModifiedUtc'] = modified
+    mock.dataset.items[event_id][0]['EventItemTitle'] = title
+    return mock.dataset.items[event_id][0]['EventItemId']
+
+
+def test_first_fetch_seeds_marks(mock_legistar, run):
+    run(fetch_more_events(NAMESPACE, limit=3, cache=False))
+    seeded = run(marks())
+    assert seeded[EVENTMARK] == \
+        mock_legistar.dataset.events[2]['EventLastModifiedUtc']
+
+
+def test_fetch_does_not_advance_marks(mock_legistar, run):
+    '''an edit to a stored event made before a later fetch is still synced'''
+    run(fetch_more_events(NAMESPACE, limit=3, cache=False))
+    seeded = run(marks())
+    # edited after the first fetch, but before the newest events were made
+    newest = mock_legistar.dataset.events[-1]['EventLastModifiedUtc']
+    modified = datetime.fromisoformat(seeded[EVENTMARK]) \
+        .replace(hour=12).isoformat()
+    assert seeded[EVENTMARK] < modified < newest
+    item_id = edit(mock_legistar, 2, 'edited title', modified)
+
+    run(fetch_more_events(NAMESPACE, limit=10, cache=False))
+    assert run(marks()) == seeded
+    run(sync_events(NAMESPACE))
+
+    title, = run(stored(
+        select(db.items.c.title).where(db.items.c.id == item_id)
+    ))[0]
+    assert title == 'edited title'
+    assert run(marks())[EVENTMARK] == newest
+
+
+def fetch_partly_archived(run, monkeypatch):
+    '''a db with 6 events, only the last 3 of them archived'''
+    monkeypatch.setattr(archive, 'ENABLED', False)
+    run(fetch_more_events(NAMESPACE, limit=3, cache=False))
+    monkeypatch.setattr(archive, 'ENABLED', True)
+    run(fetch_more_events(NAMESPACE, limit=3, cache=False))
+
+
+def test_rebuild_keeps_events_missing_from_archive(
+    mock_legistar, run, monkeypatch
+):
+    fetch_partly_archived(run, monkeypatch)
+    before = run(stored(select(db.events.c.id)))
+    assert len(before) == 6
+
+    run(rebuild(NAMESPACE, jobs=1))
+    assert run(stored(select(db.events.c.id))) == before
+
+    run(rebuild(NAMESPACE, jobs=1, force=True))
+    assert {row.id for row in run(stored(select(db.events.c.id)))} == \
+        {4, 5, 6}
+
+
+def test_rebuild_leaves_db_in_use_alone(mock_legistar, run, monkeypatch):
+    run(fetch_more_events(NAMESPACE, limit=6, cache=False))
+    monkeypatch.setitem(db.POOL, 'connect_args', {'timeout': 0.1})
+    writer = sqlite3.connect(db.db_file(NAMESPACE))
+    reader = sqlite3.connect(db.db_file(NAMESPACE))
+    try:
+        writer.execute(
+            "UPDATE events SET location = 'edited' WHERE id = 1"
+        )
+        writer.commit()
+        # a reader in the middle of a transaction, on a snapshot in the wal
+        reader.execute('BEGIN')
+        reader.execute('SELECT count(*) FROM events').fetchone()
+        run(rebuild(NAMESPACE, jobs=1))
+        assert os.path.getsize(db.db_file(NAMESPACE) + '-wal')
+        assert os.path.exists(db.db_file(f'{NAMESPACE}.rebuild'))
+    finally:
+        reader.close()
+        writer.close()
+    location, = run(stored(
+        select(db.events.c.location).where(db.events.c.id == 1)
+    ))[0]
+    assert location == 'edited'
+
+    run(rebuild(NAMESPACE, jobs=1))
+    assert not os.path.exists(db.db_file(f'{NAMESPACE}.rebuild'))
@@ -0,0 +1,37 @@
+import asyncio
+import httpx
+import pytest
+from legisearch import legistar
+from legisearch.models import Event
+
+
+def item(item_id, matter_id):
+    return {'EventItemId': item_id, 'EventItemMatterId': matter_id,
+            'EventItemMatterAttachments': []}
+
+
+def test_fetch_items_cancels_matter_fetches():
+    '''a failing matter must not leave the other matter fetches running'''
+    async def handler(request):
+        if request.url.path.endswith('/Matters/5'):
+            return httpx.Response(500)
+        if '/Matters/' in request.url.path:
+            await asyncio.Event().wait()  # never answers
+        return httpx.Response(200, json=[item(1, 5), item(2, 6)])
+
+    async def events():
+        yield Event.from_api({'EventId': 1, 'EventAgendaFile': 'a.pdf'})
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        ) as client:
+            pairs = legistar.fetch_items(
+                client, 'test', events(), fetch_matter_text=True
+            )
+            with pytest.raises(httpx.HTTPStatusError):
+                await pairs.__anext__()
+        return [t for t in asyncio.all_tasks()
+                if t is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
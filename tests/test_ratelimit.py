@@ -0,0 +1,125 @@
+import asyncio
+import time
+import httpx
+import pytest
+from benchmarks.mocklegistar import Dataset, MockLegistar
+from legisearch import ratelimit
+from legisearch.ratelimit import CircuitBreaker, RateLimitTransport
+
+URL = 'https://legistar.test/v1/test/bodies'
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'limiters', {})
+    monkeypatch.setattr(ratelimit, 'breakers', {})
+    monkeypatch.setattr(ratelimit, 'RATE', 1000.0)
+
+
+def transport(handler, **kwargs):
+    return RateLimitTransport(httpx.MockTransport(handler), **kwargs)
+
+
+def open_breaker():
+    breaker = ratelimit.breaker_for('test')
+    breaker.cooldown = 0
+    for _ in range(breaker.max_failures):
+        breaker.failure()
+    return breaker
+
+
+async def get(transport):
+    async with httpx.AsyncClient(transport=transport) as client:
+        return await client.get(URL)
+
+
+def test_breaker_opens_and_closes():
+    breaker = CircuitBreaker(failures=2, cooldown=0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.allow()  # the test request
+    assert not breaker.allow()  # only one at a time
+    breaker.success()
+    assert breaker.allow() and breaker.opened is None
+
+
+def test_cancelled_probe_releases_breaker():
+    breaker = open_breaker()
+
+    async def hang(request):
+        await asyncio.Event().wait()
+
+    async def run():
+        probe = asyncio.ensure_future(get(transport(hang)))
+        await asyncio.sleep(0.01)
+        assert breaker.testing is not None
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(run())
+    assert breaker.testing is None
+    assert breaker.allow()
+
+
+def test_failed_probe_releases_breaker():
+    breaker = open_breaker()
+
+    def broken(request):
+        raise ValueError('not a transport error')
+
+    with pytest.raises(ValueError):
+        asyncio.run(get(transport(broken)))
+    assert breaker.allow()
+
+
+def test_long_retry_after_is_not_cut_short(monkeypatch):
+    calls = []
+
+    def throttled(request):
+        calls.append(request)
+        return httpx.Response(429, headers={'Retry-After': '3600'})
+
+    response = asyncio.run(get(transport(throttled)))
+    assert response.status_code == 429
+    assert len(calls) == 1
+
+
+def test_retry_after_is_honored(monkeypatch):
+    waits = []
+
+    async def sleep(seconds):
+        waits.append(seconds)
+
+    monkeypatch.setattr(ratelimit.asyncio, 'sleep', sleep)
+    responses = iter([
+        httpx.Response(503, headers={'Retry-After': '30'}),
+        httpx.Response(200, json=[]),
+    ])
+    response = asyncio.run(get(transport(lambda request: next(responses))))
+    assert response.status_code == 200
+    assert waits[0] == 30.0
+
+
+def test_latency_leaves_out_pool_wait():
+    '''requests queued for the only connection do not look slow'''
+    with MockLegistar(Dataset(1), latency=0.05, jitter=0) as mock:
+        limits = httpx.Limits(max_connections=1)
+        inner = httpx.AsyncHTTPTransport(limits=limits)
+
+        async def run():
+            async with httpx.AsyncClient(
+                transport=RateLimitTransport(inner)
+            ) as client:
+                started = time.monotonic()
+                await asyncio.gather(*(
+                    client.get(f'{mock.baseurl}test/bodies')
+                    for _ in range(8)
+                ))
+                return time.monotonic() - started
+
+        assert asyncio.run(run()) > 0.35
+    limiter = ratelimit.limiter_for('127.0.0.1')
+    assert limiter.latency < 0.1
+    assert limiter.rate == limiter.max_rate
@@ -0,0 +1,77 @@
+from collections import Counter
+import pytest
+from legisearch import db
+from legisearch.fetch import fetch_more_events
+from legisearch.search import search, search_query, cursor
+
+NAMESPACE = 'test'
+
+
+@pytest.fixture
+def fetched(mock_legistar, run):
+    run(fetch_more_events(NAMESPACE, limit=6, cache=False))
+    return mock_legistar
+
+
+def rows(run, **kwargs):
+    async def collect():
+        return [dict(row) async for row in search(NAMESPACE, **kwargs)]
+    return run(collect())
+
+
+def pages(run, order, limit, **kwargs):
+    '''every row, a page of `limit` at a time'''
+    found, after = [], None
+    while True:
+        page = rows(run, order=order, after=after, limit=limit, **kwargs)
+        assert len(page) <= limit
+        found.extend(page)
+        if len(page) < limit:
+            return found
+        after = cursor(page[-1], order)
+
+
+def common_word(mock) -> str:
+    words = Counter(
+        word for items in mock.dataset.items.values() for item in items
+        for word in (item['EventItemTitle'] or '').split() if word.isalpha()
+    )
+    return words.most_common(1)[0][0]
+
+
+@pytest.mark.parametrize('order', ['newest', 'oldest'])
+def test_pages_by_meeting_time(fetched, run, order):
+    columns = ('title',)
+    everything = rows(run, order=order, columns=columns)
+    assert len(everything) > 10
+    # meetings share times, so pages also split between events and items
+    assert pages(run, order, 4, columns=columns) == everything
+
+
+def test_pages_by_rank(fetched, run):
+    word = common_word(fetched)
+    everything = rows(run, search_string=word, columns=('title',))
+    assert len(everything) > 3
+    assert [row['rank'] for row in everything] == \
+        sorted(row['rank'] for row in everything)
+    assert pages(
+        run, 'rank', 3, search_string=word, columns=('title',)
+    ) == everything
+
+
+def test_bad_cursor_and_order():
+    with pytest.raises(ValueError):
+        search_query(order='newest', after='nonsense')
+    with pytest.raises(ValueError):
+        search_query(order='rank')
+    with pytest.raises(ValueError):
+        search_query(month=3)
+
+
+def test_first_page_seeks_after_fetch(fetched, run):
+    '''fetch leaves the statistics the planner needs to use events_time'''
+    async def plan():
+        async with db.new_connection(NAMESPACE) as conn:
+            return await db.explain(conn, search_query(limit=20))
+    steps = run(plan())
+    assert any('events_time' in step for step in steps[:1])